@@ -0,0 +1,120 @@
+"""
+Adaptive tracing of 1D sources (lin2d CollimatedSource and PointSource) into a sensors.Image
+The parameter range of the source is split into num intervals, each traced as the ray at its middle and weighted by
+its width, then intervals are bisected where splitting them still changes the image by more than the tolerance
+Flat regions of the image converge after one split, rays are only spent on edges, stops and lenslet boundaries
+"""
+
+import numpy as np
+
+
+def refine(system, source, sensor, tol = .01, max_rays = 2**20, max_depth = 24, fused = True):
+    """
+    Adds an adaptively refined source to the sensor
+    The error estimate of a pixel is the absolute change of its value when the intervals reaching it were split,
+    the pixels are converged once it's below tol times the brightest pixel of the image
+    Neighbouring rays that differ in being stopped or land too far apart straddle a stop, a lenslet boundary or a
+    steep part of the image, their intervals are split until they carry less light than that
+    :param system: lin2d.OpticsSystem
+    :param source: source with bounds and at(), its num is the number of intervals to start from
+    :param sensor: sensors.Image, the image is added to sensor.img
+    :param tol: allowed error of a pixel as a fraction of the brightest pixel
+    :param max_rays: budget of traced rays, the brightest intervals are split first
+    :param max_depth: most times an interval of the starting grid is bisected
+    :return: parameter values and widths of the final rays, and the per-pixel error estimate of the last split
+    """
+    lo, hi = source.bounds
+    scale = source.num / (hi - lo)  # weights are widths relative to those of a uniform source of num rays
+    # neighbouring rays further apart than this misplace more than tol of the light of the pixels between them,
+    # the midpoint rule is off by h**2 / 8 at the kinks of the bilinear footprint of a pixel
+    spacing = np.sqrt(8 * tol) * 2 * sensor.r_max / (sensor.n_px - 1)
+
+    # intervals sorted by parameter, each traced as the ray at its middle
+    widths = np.full(source.num, (hi - lo) / source.num)
+    values = lo + (np.arange(source.num) + .5) * widths
+    depth = np.zeros(source.num, dtype=np.int32)
+    r, halt, rgb = _trace(system, source, values, fused)
+    img = sensor.splat(r[None], rgb * (scale * widths)[:, None], halt)[0]
+
+    error = np.zeros(sensor.n_px)
+    split = np.ones(source.num, dtype=bool)  # the starting grid is split once to get a first error estimate
+    traced = source.num
+
+    while True:
+        light = sensor.intensity * rgb.sum(-1) * scale * widths
+        idx = np.flatnonzero(split)
+        budget = (max_rays - traced) // 2
+        if len(idx) > budget:
+            idx = np.sort(idx[np.argsort(-light[idx], kind='stable')[:max(budget, 0)]])
+        if len(idx) == 0:
+            break
+
+        # children at the quarter points of every split interval, child j belongs to interval idx[j // 2]
+        half = widths[idx] / 2
+        c_values = np.stack([values[idx] - half / 2, values[idx] + half / 2], axis=-1).ravel()
+        c_widths = np.repeat(half, 2)
+        c_r, c_halt, c_rgb = _trace(system, source, c_values, fused)
+        traced += len(c_values)
+
+        # change of every pixel, split by interval, from replacing each interval by its two children
+        parent, pixel, change = [np.concatenate(pair) for pair in zip(
+            _footprint(sensor, r[idx], -light[idx], halt[idx]),
+            _footprint(sensor, c_r, sensor.intensity * c_rgb.sum(-1) * scale * c_widths, c_halt,
+                       owner=np.arange(len(c_values)) // 2))]
+
+        key, inverse = np.unique(parent * sensor.n_px + pixel, return_inverse=True)
+        change = np.abs(np.bincount(inverse, change))
+        parent, pixel = key // sensor.n_px, key % sensor.n_px
+
+        img += (sensor.splat(c_r[None], c_rgb * (scale * c_widths)[:, None], c_halt)[0]
+                - sensor.splat(r[idx][None], rgb[idx] * (scale * widths[idx])[:, None], halt[idx])[0])
+        error = np.bincount(pixel, change, minlength=sensor.n_px)
+        limit = tol * img.sum(-1).max()
+
+        # children replace their interval in place, so the intervals stay sorted
+        counts = np.ones(len(values), dtype=np.intp)
+        counts[idx] = 2
+        slots = (np.cumsum(counts) - counts)[idx]
+        slots = np.stack([slots, slots + 1], axis=-1).ravel()
+
+        def replace(array, children):
+            array = np.repeat(array, counts, axis=0)
+            array[slots] = children
+            return array
+
+        values, widths = replace(values, c_values), replace(widths, c_widths)
+        r, halt, rgb = replace(r, c_r), replace(halt, c_halt), replace(rgb, c_rgb)
+        depth = replace(depth, np.repeat(depth[idx] + 1, 2))
+
+        # intervals whose split still moved light in a pixel that isn't converged are split again
+        moved = np.bincount(parent, change * (error[pixel] > limit), minlength=len(idx)) > 0
+        split = np.zeros(len(values), dtype=bool)
+        split[slots] = np.repeat(moved, 2)
+
+        # and so are bright neighbours on either side of an edge
+        visible = ~halt & (np.abs(r) <= sensor.r_max)
+        edge = (visible[:-1] != visible[1:]) | (visible[:-1] & visible[1:] & (np.abs(np.diff(r)) > spacing))
+        bright = sensor.intensity * rgb.sum(-1) * scale * widths > limit
+        split[:-1] |= edge & bright[:-1]
+        split[1:] |= edge & bright[1:]
+
+        split &= depth < max_depth
+
+    sensor.img += img
+    return values, widths, error
+
+
+def _trace(system, source, values, fused):
+    """:return: final heights, halt mask and float colors of the rays of the source at values"""
+    rays = system.trace(source.at(values), fused=fused)
+    return rays.rt[..., 0], rays.halt, rays.get_rgb().astype(np.float64)
+
+
+def _footprint(sensor, r, weight, halt, owner = None):
+    """:return: owner, pixel and weight of both bilinear splat entries of every live ray on the sensor"""
+    ray = np.flatnonzero(~halt & (np.abs(r) <= sensor.r_max))
+    upper, lower, frac = sensor.pixels(r[ray])
+    owner = ray if owner is None else owner[ray]
+
+    return (np.concatenate([owner, owner]), np.concatenate([upper, lower]),
+            np.concatenate([weight[ray] * frac, weight[ray] * (1 - frac)]))
@@ -0,0 +1,139 @@
+"""
+Closed form first-order properties of a lin2d.OpticsSystem, found from its composite ABCD matrix
+The matrix runs from the first element of the system to the last one, the final propagate distance is left out,
+distances are measured from the first element (front) and from the end of the last element (back)
+Every function broadcasts, so object distances, propagate distances and swept (K, 2, 2) systems are all vectorized
+"""
+
+import numpy as np
+from .elements.lin2d import OpticsSystem, matrix
+from .rays.rays2d import RayArray
+
+
+def abcd(system):
+    """:return: A, B, C and D of the system between its first and last element"""
+    SYS = system.subsystem(0, len(system) - 1)
+    return SYS[..., 0, 0], SYS[..., 0, 1], SYS[..., 1, 0], SYS[..., 1, 1]
+
+
+def planes(system):
+    """:return: axial positions of the front and back reference planes the distances are measured from"""
+    last = system[-2]
+    return system[0].z, last.z + last.B
+
+
+def efl(system):
+    """:return: effective focal length, -1/C"""
+    return -1 / abcd(system)[2]
+
+
+def bfd(system):
+    """:return: back focal distance, from the back plane to the back focal point, -A/C"""
+    A, _, C, _ = abcd(system)
+    return -A / C
+
+
+def ffd(system):
+    """:return: front focal distance, from the front focal point to the front plane, -D/C"""
+    _, _, C, D = abcd(system)
+    return -D / C
+
+
+def principal_planes(system):
+    """
+    :return: axial positions of the front and back principal planes,
+             (D - 1)/C from the front plane and (1 - A)/C from the back plane
+    """
+    A, _, C, D = abcd(system)
+    front, back = planes(system)
+    return front + (D - 1) / C, back + (1 - A) / C
+
+
+def image_distance(system, s):
+    """
+    :param s: distances of the object in front of the front plane, np.inf for an object at infinity
+    :return: distances of the image behind the back plane, -(A s + B)/(C s + D), the system's propagate to focus
+    """
+    A, B, C, D = abcd(system)
+    s = np.asarray(s, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(np.isinf(s), -A / C, -(A*s + B) / (C*s + D))
+
+
+def magnification(system, s):
+    """
+    :param s: distances of the object in front of the front plane
+    :return: lateral magnification of the image, (AD - BC)/(C s + D)
+    """
+    A, B, C, D = abcd(system)
+    return (A*D - B*C) / (C*np.asarray(s, dtype=np.float64) + D)
+
+
+def moments(system, rays):
+    """
+    Centroid and covariance of the (r, theta) state of the rays at the back plane
+    Linear systems carry the moments of the rays through the matrix, systems with stops or lenslet arrays are traced
+    once without the final propagate distance, broadcast to (K, N) rays when the system is swept
+    :param rays: Bundle or RayArray, left unchanged
+    :return: (2,) centroid and (2, 2) covariance, with a leading K axis for swept systems
+    """
+    rays = rays.sample(history=False) if hasattr(rays, 'sample') else rays.take(np.arange(len(rays)))
+    rays.history = None
+    SYS = system.subsystem(0, len(system) - 1)
+
+    if all(element.linear for element in system):
+        # states of the rays at the front plane, then through the matrix
+        r, t = rays.rt[..., 0] + (system[0].z - rays.z) * rays.rt[..., 1], rays.rt[..., 1]
+    else:
+        # rays are broadcast to (K, N) for swept systems, the same as OpticsSystem.sweep does
+        K = SYS.shape[:-2]
+        if K:
+            halt = rays.halt
+            rays = RayArray(np.broadcast_to(rays.rt[..., 1], K + halt.shape), rays.rt[..., 0], z=rays.z,
+                            n_current=rays.n, color=rays.color, history=False)
+            rays.halt |= halt
+
+        OpticsSystem(system[0::2], propagate=0).trace(rays, fused=True)
+        r, t = rays.rt[..., 0], rays.rt[..., 1]
+        SYS = np.identity(2)
+
+    # moments of the live rays of every configuration
+    live = ~np.broadcast_to(rays.halt, r.shape)[..., None, :]
+    n = np.count_nonzero(live, axis=-1)
+    state = np.stack([r, t], axis=-2)
+    mean = np.where(live, state, 0).sum(axis=-1) / n
+    centered = np.where(live, state - mean[..., None], 0)
+    cov = centered @ np.swapaxes(centered, -1, -2) / n[..., None]
+
+    return (SYS @ mean[..., None])[..., 0], SYS @ cov @ np.swapaxes(SYS, -1, -2)
+
+
+def spot_size(system, rays, distances):
+    """
+    Through-focus curve of the rms spot radius of the rays, r(L) = r + L theta
+    :param rays: Bundle or RayArray entering the system
+    :param distances: array of propagate distances behind the back plane
+    :return: rms radius about the centroid at every distance
+    """
+    _, cov = moments(system, rays)
+    L = np.asarray(distances, dtype=np.float64)
+    rr, rt, tt = cov[..., 0, 0, None], cov[..., 0, 1, None], cov[..., 1, 1, None]
+
+    return np.sqrt(np.maximum(rr + 2*L*rt + L**2*tt, 0)).reshape(np.shape(rr)[:-1] + L.shape)
+
+
+def focus(system, rays):
+    """
+    Propagate distance of the smallest rms spot, the minimum of the quadratic of spot_size
+    :return: distance behind the back plane and the rms radius there
+    """
+    _, cov = moments(system, rays)
+    rr, rt, tt = cov[..., 0, 0], cov[..., 0, 1], cov[..., 1, 1]
+
+    L = -rt / tt
+    return L, np.sqrt(np.maximum(rr - rt**2 / tt, 0))
+
+
+def propagated(system, distances):
+    """:return: (..., K, 2, 2) matrices of the system followed by each of K propagate distances"""
+    return matrix(1, distances, 0, 1) @ np.expand_dims(system.subsystem(0, len(system) - 1), -3)
@@ -0,0 +1,269 @@
+"""
+Throughput benchmarks for sources, tracing and sensor accumulation
+Every canonical scenario is timed at sizes from 1e2 up to 1e7 rays, and reports rays per second,
+the peak memory and the memory blocks the run left allocated per ray, measured with tracemalloc
+CPython has no allocation counter, tracemalloc only sees blocks that are still alive, so temporary allocation churn
+shows up in the peak memory rather than in the retained blocks, which catch leaks and per-ray objects that are kept
+
+Run as a module, e.g. python -m opticspy.benchmarks --max 1e6 --json results.json
+Pass --baseline results.json to exit with an error when any throughput drops by more than --tolerance
+The time to import the core tracing modules in a fresh interpreter is checked against --import-budget first,
+since every worker process pays it, --import-only stops after that check
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+from .elements import lin2d, lin4d
+from .rays import rays4d
+from . import sensors
+
+SIZES = [10**k for k in range(2, 8)]
+SCALAR_MAX = 10**4  # the per-ray calcPath loop is only run up to this many rays
+
+CORE_MODULES = ['elements.lin2d', 'elements.lin4d', 'rays.rays2d', 'rays.rays4d', 'sensors', 'parallel', 'dataset',
+                'profiling', 'analysis', 'sampling', 'adaptive']
+IMPORT_BUDGET = .1  # seconds to import every core module on top of numpy
+OPTIONAL = ['matplotlib', 'scipy']  # only imported when plotting, named colormaps or a KD-tree are used
+
+
+class Scenario:
+    """
+    Optical system together with a source of n rays and the sensor at its end
+    """
+    def __init__(self, name, system, source, sensor):
+        """
+        :param source: function of n returning a Bundle or RayArray
+        :param sensor: function returning an empty sensor
+        """
+        self.name = name
+        self.system = system
+        self.source = source
+        self.sensor = sensor
+
+    def rays(self, n):
+        source = self.source(n)
+        return source.asArray() if hasattr(source, 'asArray') else source
+
+    @property
+    def is4d(self):
+        return isinstance(self.system, lin4d.OpticsSystem)
+
+    def trace(self, rays):
+        if self.is4d:
+            return self.system.trace(rays)
+        return self.system.trace(rays, fused=True)
+
+
+def relay_4f():
+    system = lin2d.OpticsSystem([lin2d.ThinLens(50, loc=0), lin2d.ThinLens(50, loc=100)], propagate=50)
+    return Scenario('4f relay', system,
+                    lambda n: lin2d.CollimatedSource(5, num=n, zstart=-50, theta=.01, history=False),
+                    lambda: sensors.Image(6, .01))
+
+
+def plenoptic():
+    system = lin2d.OpticsSystem([lin2d.ThinLens(100, loc=0), lin2d.ThinLensMLA(2, .1, loc=100)], propagate=2)
+    return Scenario('MLA plenoptic', system,
+                    lambda n: lin2d.PointSource(-200, .5, .02, num=n, history=False),
+                    lambda: sensors.Image(3, .005))
+
+
+def stop_limited():
+    system = lin2d.OpticsSystem([lin2d.ThinLens(50, loc=0), lin2d.Stop(2, loc=25), lin2d.ThinLens(25, loc=75)],
+                                propagate=25)
+    return Scenario('stop limited', system,
+                    lambda n: lin2d.CollimatedSource(5, num=n, zstart=-10, theta=.02, history=False),
+                    lambda: sensors.Image(6, .01))
+
+
+def skew_4d():
+    system = lin4d.OpticsSystem([lin4d.ThinLens(50, np.inf, 0), lin4d.ThinLensMLA(5, .3, 30, 'hex', 30),
+                                 lin4d.StopCirc(4, 45), lin4d.ThinLens(20, np.inf, 60)], propagate=25)
+
+    def source(n):
+        rng = np.random.default_rng(0)
+        x, y = rng.uniform(-5, 5, (2, n))
+        t, p = rng.uniform(-.02, .02, (2, n))
+        return rays4d.RayArray(x, y, t, p, -10, history=False)
+
+    return Scenario('4D skew', system, source, lambda: sensors.Image2D(5, .02))
+
+
+SCENARIOS = [relay_4f, plenoptic, stop_limited, skew_4d]
+
+
+# each stage does its untimed setup and returns the function that is measured
+
+def stage_source(scenario, n):
+    return lambda: scenario.rays(n)
+
+
+def stage_trace(scenario, n):
+    rays = scenario.rays(n)
+    return lambda: scenario.trace(rays)
+
+
+def stage_accumulate(scenario, n):
+    source, sensor = scenario.source(n), scenario.sensor()
+    return lambda: scenario.system.accumulate(source, sensor)
+
+
+def stage_scalar(scenario, n):
+    """The original per-ray pipeline, calcPath on every Path and Image.Add"""
+    source, sensor = scenario.source(n), scenario.sensor()
+
+    def run():
+        for ii in range(n):
+            path = source[ii]
+            scenario.system.calcPath(path)
+            sensor.Add(path)
+        return sensor
+
+    return run
+
+
+STAGES = {'source': stage_source, 'trace': stage_trace, 'accumulate': stage_accumulate, 'scalar': stage_scalar}
+
+
+def measure(stage, scenario, n, repeat = 3):
+    """
+    Times the best of repeat runs, then runs once more under tracemalloc, which slows it down, for the memory
+    retained_blocks_per_ray counts the blocks allocated during the run that are still alive at its end
+    :return: dict of the results
+    """
+    seconds = np.inf
+    for _ in range(repeat):
+        run = stage(scenario, n)
+        start = time.perf_counter()
+        run()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    run = stage(scenario, n)
+    tracemalloc.start()
+    result = run()
+    _, peak = tracemalloc.get_traced_memory()
+    retained = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    del result
+
+    return {'seconds': seconds, 'rays_per_s': n / seconds, 'peak_bytes': peak,
+            'bytes_per_ray': peak / n, 'retained_blocks_per_ray': retained / n}
+
+
+def run(sizes = SIZES, stages = STAGES, repeat = 3, out = sys.stdout):
+    """
+    Measures every stage of every scenario at every size
+    :return: list of result dicts
+    """
+    results = []
+    print(f"{'scenario':<14}{'stage':<12}{'rays':>10}{'seconds':>10}{'rays/s':>12}{'peak MB':>10}"
+          f"{'B/ray':>9}{'kept blk/ray':>14}", file=out)
+
+    for make in SCENARIOS:
+        scenario = make()
+        for name, stage in stages.items():
+            if name == 'scalar' and scenario.is4d:
+                continue
+            for n in sizes:
+                if name == 'scalar' and n > SCALAR_MAX:
+                    continue
+
+                result = {'scenario': scenario.name, 'stage': name, 'rays': n,
+                          **measure(stage, scenario, n, repeat=repeat if n < 10**6 else 1)}
+                results.append(result)
+                print(f"{scenario.name:<14}{name:<12}{n:>10}{result['seconds']:>10.4f}{result['rays_per_s']:>12.3g}"
+                      f"{result['peak_bytes'] / 2**20:>10.1f}{result['bytes_per_ray']:>9.1f}"
+                      f"{result['retained_blocks_per_ray']:>14.4f}", file=out, flush=True)
+
+    return results
+
+
+def import_time(modules = CORE_MODULES, repeat = 5):
+    """
+    Times importing the modules in fresh interpreters, numpy is imported before the clock starts
+    :return: best time in seconds and the optional dependencies the imports loaded
+    """
+    package = __package__ or os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = (f"import sys, time, numpy\n"
+            f"start = time.perf_counter()\n"
+            f"import {', '.join(f'{package}.{module}' for module in modules)}\n"
+            f"print(time.perf_counter() - start)\n"
+            f"print(' '.join(name for name in {OPTIONAL!r} if name in sys.modules))")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+
+    seconds, loaded = np.inf, []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+        lines = out.stdout.splitlines()
+        seconds, loaded = min(seconds, float(lines[0])), lines[1].split() if len(lines) > 1 else []
+
+    return seconds, loaded
+
+
+def check_imports(budget = IMPORT_BUDGET, out = sys.stdout):
+    """
+    :return: whether the core modules import within budget seconds without loading an optional dependency
+    """
+    seconds, loaded = import_time()
+    print(f"core import {seconds:.4f} s, budget {budget:.4f} s" + (f", loaded {' '.join(loaded)}" if loaded else ''),
+          file=out)
+    if seconds > budget or loaded:
+        print("import budget exceeded", file=out)
+        return False
+    return True
+
+
+def compare(results, baseline, tolerance = .2):
+    """
+    :return: list of the results whose rays per second dropped by more than tolerance against the baseline
+    """
+    reference = {(r['scenario'], r['stage'], r['rays']): r['rays_per_s'] for r in baseline}
+    return [r for r in results
+            if (r['scenario'], r['stage'], r['rays']) in reference
+            and r['rays_per_s'] < (1 - tolerance) * reference[(r['scenario'], r['stage'], r['rays'])]]
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max', type=float, default=1e7, help='largest number of rays')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='file to write the results to')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=.2, help='allowed fractional drop in rays per second')
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET,
+                        help='largest allowed import time of the core modules in seconds')
+    parser.add_argument('--import-only', action='store_true', help='only check the import budget')
+    args = parser.parse_args(argv)
+
+    if not check_imports(args.import_budget):
+        return 1
+    if args.import_only:
+        return 0
+
+    sizes = [n for n in SIZES if n <= args.max]
+    results = run(sizes, {name: STAGES[name] for name in args.stages}, repeat=args.repeat)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        for r in slower:
+            print(f"regression: {r['scenario']} {r['stage']} {r['rays']} rays at {r['rays_per_s']:.3g} rays/s")
+        return 1 if slower else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
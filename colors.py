@@ -1,4 +1,5 @@
 import numpy as np
+from functools import lru_cache
 
 
 def rgb2hex(rgb):
@@ -7,7 +8,17 @@ def rgb2hex(rgb):
     :param rgb: Array of rbg values
     :return: String of hex values
     """
+    return _rgb2hex(tuple(rgb))
 
+def rgb2hex8(rgb):
+    """
+    Converts unsigned 8 bit rgb values, such as a row of a RayArray color array, to a hex string
+    Unlike rgb2hex, dark colors are never taken for 0-1 float values
+    """
+    return '#%02x%02x%02x' % tuple(int(v) for v in rgb)
+
+@lru_cache(maxsize=4096)
+def _rgb2hex(rgb):
     if len(rgb) != 3:
         raise ValueError("RBG Array wrong size")
     elif max(rgb) > 255:
@@ -17,9 +28,11 @@ def rgb2hex(rgb):
 
     return f"#{int(rgb[0]):02x}{int(rgb[1]):02x}{int(rgb[2]):02x}"
 
+@lru_cache(maxsize=4096)
 def hex2rgb(hex_str):
     """
     Converts a hex number string representing color into rgb values
+    Results are cached, so the returned array is read-only
     :param hex_str: 7 character string with the first character being ignored
     :return: unsigned 8 bit integer array of red green and blue values
     """
@@ -29,4 +42,6 @@ def hex2rgb(hex_str):
     r, g, b = '0x' + hex_str[1:3], '0x' + hex_str[3:5], '0x' + hex_str[5:]
     r, g, b = int(r, 0), int(g, 0), int(b, 0)
 
-    return np.array([r, g, b], dtype = np.uint8)
\ No newline at end of file
+    rgb = np.array([r, g, b], dtype = np.uint8)
+    rgb.flags.writeable = False
+    return rgb
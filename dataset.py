@@ -0,0 +1,147 @@
+"""
+On-disk format for traced rays
+A dataset is a directory of flat .npy arrays, one per ray attribute, and a small JSON header
+The arrays are opened memory-mapped, so slicing a dataset only reads the rays that are used
+"""
+
+import os
+import json
+import numpy as np
+from .rays import rays2d, rays4d
+
+VERSION = 1
+
+
+def save(path, rays, system = None):
+    """
+    Writes a RayArray, 2D or 4D, or a Bundle and its recorded history to a dataset directory
+    :param path: directory to write, created if it doesn't exist
+    :param rays: RayArray, or a Bundle whose state is saved
+    :param system: optional OpticsSystem the rays were traced through, its elements are listed in the header
+    """
+    if hasattr(rays, 'asArray'):
+        rays = rays.asArray()
+    os.makedirs(path, exist_ok=True)
+
+    if isinstance(rays, rays4d.RayArray):
+        kind, state = '4d', rays.state
+        palette, color_idx = rays.palette, rays.color_idx
+    else:
+        kind, state = '2d', rays.rt
+        palette, color_idx = np.unique(rays.get_rgb().reshape(-1, 3), axis=0, return_inverse=True)
+        color_idx = color_idx.reshape(rays.halt.shape).astype(np.min_scalar_type(len(palette)))
+
+    arrays = {'state': state, 'halt': rays.halt, 'halted_at': rays.halted_at, 'color_idx': color_idx}
+    if kind == '2d':
+        arrays['z'] = rays.z
+    if rays.history is not None:
+        arrays['history'] = rays.history.view()
+
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), array)
+
+    header = {
+        'version': VERSION,
+        'kind': kind,
+        'num': len(rays),
+        'n': float(rays.n),
+        'n_steps': 0 if rays.history is None else len(rays.history),
+        'palette': np.asarray(palette, dtype=np.uint8).tolist(),  # [r, g, b] integers, no hex round trip
+        'elements': [] if system is None else [{'type': type(element).__name__, 'z': _position(element)}
+                                               for element in system],
+    }
+    with open(os.path.join(path, 'header.json'), 'w') as f:
+        json.dump(header, f, indent=1)
+
+
+def load(path, mmap_mode = 'r'):
+    """
+    Opens a dataset directory without reading its arrays into memory
+    :param mmap_mode: numpy memmap mode, 'r' read only, 'r+' to modify the saved rays in place
+    :return: RayDataset
+    """
+    return RayDataset(path, mmap_mode=mmap_mode)
+
+
+def _position(element):
+    z = getattr(element, 'z', None)
+    return None if z is None else float(z)
+
+
+class RayDataset:
+    """
+    Memory-mapped rays of a saved dataset
+    Slicing gives a RayArray whose arrays are views of the files, sample copies the rays so they can be traced again
+    """
+
+    def __init__(self, path, mmap_mode = 'r'):
+        self.path = path
+        with open(os.path.join(path, 'header.json')) as f:
+            self.header = json.load(f)
+        if self.header['version'] > VERSION:
+            raise ValueError(f"Dataset version {self.header['version']} is newer than {VERSION}")
+
+        self.kind = self.header['kind']
+        self.n = self.header['n']
+        self.elements = self.header['elements']
+        self.palette = np.array(self.header['palette'], dtype=np.uint8).reshape(-1, 3)
+
+        def open_array(name):
+            file = os.path.join(path, name + '.npy')
+            return np.load(file, mmap_mode=mmap_mode) if os.path.exists(file) else None
+
+        self.state = open_array('state')
+        self.halt = open_array('halt')
+        self.halted_at = open_array('halted_at')
+        self.color_idx = open_array('color_idx')
+        self.z = open_array('z') if self.kind == '2d' else self.state[..., 4]
+        self.history = open_array('history')
+
+    def __len__(self):
+        return self.header['num']
+
+    def __repr__(self):
+        return f"RayDataset - {len(self)} {self.kind} rays, {self.header['n_steps']} steps, {self.path}"
+
+    def __getitem__(self, item):
+        """
+        :param item: slice of rays
+        :return: RayArray of the rays in the slice, its state and history are views of the files
+        """
+        if not isinstance(item, slice):
+            raise TypeError("RayDataset only supports slicing")
+
+        return self._array(item, lambda array: array[item])
+
+    def sample(self, start = 0, stop = None, history = True):
+        """
+        :return: RayArray of rays start to stop copied into memory, so it can be traced
+        """
+        item = slice(start, len(self) if stop is None else stop)
+        copy = lambda array: np.array(array[item])
+        return self._array(item, copy, history=history)
+
+    def asArray(self):
+        return self[:]
+
+    def _array(self, item, take, history = True):
+        if self.kind == '4d':
+            rays = rays4d.RayArray.__new__(rays4d.RayArray)
+            rays._state = take(self.state)
+            rays.palette, rays.color_idx = self.palette, take(self.color_idx)
+        else:
+            rays = rays2d.RayArray.__new__(rays2d.RayArray)
+            rays._rt, rays.z = take(self.state), take(self.z)
+            rays.palette, rays.color_idx = self.palette, take(self.color_idx)
+
+        rays.n = self.n
+        rays.halt = take(self.halt)
+        rays.halted_at = np.full(rays.halt.shape, -1, dtype=np.int32) if self.halted_at is None else take(self.halted_at)
+        rays.history = None
+
+        if history and self.history is not None:
+            rays.history = rays2d.History.__new__(rays2d.History)
+            rays.history.states = take(self.history)
+            rays.history.n_steps = self.header['n_steps']
+
+        return rays
@@ -1,34 +1,133 @@
 from ..colors import rgb2hex, hex2rgb
-from ..rays.rays2d import Path
-from functools import lru_cache
-from matplotlib.pyplot import get_cmap
+from ..rays.rays2d import RayArray, chunks
+from ..sampling import unit
+from functools import lru_cache, cached_property
+from abc import ABC, abstractmethod
+import copy
+import bisect
 import numpy as np
 
+
+def matrix(A, B, C, D):
+    """
+    Builds the 2x2 matrix [[A, B], [C, D]]
+    If any entry is an array of K values a (K, 2, 2) stack of matrices is returned
+    """
+    A, B, C, D = np.broadcast_arrays(A, B, C, D)
+    return np.stack([A, B, C, D], axis=-1).reshape(A.shape + (2, 2)).astype(np.float64)
+
+
+def expand(param):
+    """Adds a trailing axis so per-configuration parameters broadcast against (K, N) ray arrays"""
+    return np.asarray(param)[..., None]
+
+
+@lru_cache(maxsize=1024)
+def inverse(A, B, C, D):
+    """
+    Entries of the inverse of a matrix, cached on the matrix values so elements changed in place don't get stale results
+    :return: tuple of Ainv, Binv, Cinv and Dinv
+    """
+    return tuple(np.linalg.inv(matrix(A, B, C, D)).ravel())
+
+
+def get_cmap(name, lut):
+    """
+    Named matplotlib colormap resampled to lut colors
+    matplotlib is only imported here, so tracing never pays for it unless a named colormap is used
+    """
+    import matplotlib
+    return matplotlib.colormaps[name].resampled(lut)
+
+
+class MatrixTree:
+    """
+    Segment tree of the matrices of a system, every node holds the ordered product of the matrices below it
+    Replacing one matrix recomputes the log(n) products above it and any sub-system product is found in log(n)
+    """
+
+    def __init__(self, matrices):
+        self.n = len(matrices)
+        self.size = 1 << max(0, self.n - 1).bit_length()
+
+        self.nodes = [np.identity(2)] * (2 * self.size)
+        self.nodes[self.size:self.size + self.n] = matrices
+        for i in range(self.size - 1, 0, -1):
+            self.nodes[i] = self.nodes[2*i + 1] @ self.nodes[2*i]
+
+    def __setitem__(self, index, SYS):
+        i = index + self.size
+        self.nodes[i] = SYS
+        while i > 1:
+            i //= 2
+            self.nodes[i] = self.nodes[2*i + 1] @ self.nodes[2*i]
+
+    def product(self, start = 0, stop = None):
+        """:return: matrix of elements start to stop, applied in order"""
+        lo, hi = slice(start, stop).indices(self.n)[:2]
+        lo, hi = lo + self.size, hi + self.size
+
+        first, last = np.identity(2), np.identity(2)  # products of the nodes found from the left and from the right
+        while lo < hi:
+            if lo % 2:
+                first = self.nodes[lo] @ first
+                lo += 1
+            if hi % 2:
+                hi -= 1
+                last = last @ self.nodes[hi]
+            lo //= 2
+            hi //= 2
+
+        return last @ first
+
+
 class ABCD:
+    linear = True  # elements that are not a plain matrix multiplication set this to False
+
     def __init__(self, A=1, B=0, C=0, D=1, loc=0.0):
         self.A, self.B = A, B
         self.C, self.D = C, D
 
         self.z = loc
+        self.dz = B  # axial distance a ray travels through the element
 
-        self.SYS = np.array([[A, B],
-                             [C, D]],
-                            dtype = np.float64)
+        self.SYS = matrix(A, B, C, D)
 
     def __matmul__(self, ray):
-        if hasattr(ray, 'z'):
-            ray.z += self.B
+        if isinstance(ray, RayArray):
+            return self.Batch(ray)
+
+        if hasattr(ray, 'z') and not ray.halt:
+            ray.z += self.dz
         ray.rt = self.SYS @ ray.rt
 
+    def Batch(self, rays):
+        """Applies the element to every ray of a RayArray in one operation, halted rays stay where they stopped"""
+        np.add(rays.z, expand(self.dz), out=rays.z, where=~rays.halt)
+        rays.rt = rays.rt @ np.swapaxes(self.SYS, -1, -2)
+
     def __repr__(self):
         return f"ABCD Optical Element: [{self.A}, {self.B}];[{self.C}, {self.D}]"
 
-    @lru_cache
+    def abcd(self):
+        """:return: A, B, C and D computed from the physical parameters of the element"""
+        return self.A, self.B, self.C, self.D
+
+    def update(self, **params):
+        """
+        Sets parameters of the element (f, n2, z, ...) and recomputes its matrix
+        Arrays of K values give the element a (K, 2, 2) stack of matrices
+        """
+        for name, value in params.items():
+            setattr(self, name, value)
+
+        self.A, self.B, self.C, self.D = self.abcd()
+        self.dz = self.B
+        self.SYS = matrix(self.A, self.B, self.C, self.D)
+
     def Reverse(self):
-        MatInv = np.linalg.inv(self.SYS)
-        Ainv, Binv, Cinv, Dinv = MatInv.ravel()
-        RevSys = ABCD(Ainv,Binv,Cinv,Dinv,loc=self.z+self.B)
-        return RevSys
+        # a new element every time, elements are mutable through update and must not be shared between systems
+        return ABCD(*inverse(*self.SYS.ravel()), loc=self.z+self.B)
 
     def plot(self, ax, ylims):
         if hasattr(self, 'd'):
@@ -45,6 +144,9 @@ class Distance(ABCD):
 
         super().__init__(B = self.dz, loc=start)
 
+    def abcd(self):
+        return 1, self.dz, 0, 1
+
 
 class Interface(ABCD):
     def __init__(self, n2, n1 = 1, loc = 0.0):
@@ -53,6 +155,9 @@ class Interface(ABCD):
         self.z = loc
         super().__init__(D = n1/n2,loc = loc)
 
+    def abcd(self):
+        return 1, 0, 0, self.n1 / self.n2
+
 
 class ThinLens(ABCD):
     def __init__(self, focal_length, diameter = np.inf, loc = None):
@@ -61,6 +166,9 @@ class ThinLens(ABCD):
         self.d = diameter
         self.z = loc
 
+    def abcd(self):
+        return 1, 0, -1 / self.f, 1
+
 
 class Slab(ABCD):
     def __init__(self, n, thickness, loc = None):
@@ -70,8 +178,13 @@ class Slab(ABCD):
 
         super().__init__(B = self.t / self.n, loc = loc)
 
+    def abcd(self):
+        return 1, self.t / self.n, 0, 1
+
 
 class ThinLensMLA(ThinLens):
+    linear = False
+
     def __init__(self, focal_length, pitch, diameter = np.inf, loc = None):
         super().__init__(focal_length, diameter = diameter, loc = loc)
         # self.f = focal_length
@@ -83,6 +196,9 @@ class ThinLensMLA(ThinLens):
         # self.z = loc
 
     def __matmul__(self, ray):
+        if isinstance(ray, RayArray):
+            return self.Batch(ray)
+
         r, t = ray.rt
 
         lens_num = np.around(r/self.p)
@@ -93,8 +209,17 @@ class ThinLensMLA(ThinLens):
 
         ray.rt = np.array([r, rpt[1]])
 
+    def Batch(self, rays):
+        r, t = rays.rt[..., 0], rays.rt[..., 1]
+        p = expand(self.p)
+        rp = r - np.around(r/p)*p
+
+        rays.rt = np.stack([r, expand(self.C)*rp + expand(self.D)*t], axis=-1)
+
 
 class Stop(ABCD):
+    linear = False
+
     def __init__(self, r_max, r_min=None, loc=None):
         super().__init__(loc=loc)
 
@@ -105,12 +230,19 @@ class Stop(ABCD):
             self.r_min = r_min
 
     def __matmul__(self, ray):
+        if isinstance(ray, RayArray):
+            return self.Batch(ray)
+
         r = ray.rt[0]
         if r > self.r_max or r < self.r_min:
             ray.halt = True
         else:
             pass
 
+    def Batch(self, rays):
+        r = rays.rt[..., 0]
+        rays.halt |= (r > expand(self.r_max)) | (r < expand(self.r_min))
+
     def plot(self, ax, ylims):
 
         if self.B == 0:
@@ -123,14 +255,85 @@ class ThickLens(ABCD):
         self.z  = loc
         self.d = diameter
         self.t = thickness
+        self.WD = WD
+        self.f = f
 
-        B = thickness
-        C = -1 / np.sqrt(f * WD)
-
-        A = -f * C
-        D = -WD * C
+        A, B, C, D = self.abcd()
         super().__init__(A=A, B=B, C=C, D=D)
 
+    def abcd(self):
+        B = self.t
+        C = -1 / np.sqrt(self.f * self.WD)
+
+        A = -self.f * C
+        D = -self.WD * C
+        return A, B, C, D
+
+
+
+class Composite(ABCD):
+    """
+    Consecutive linear elements folded into one precomposed matrix
+    Rays are moved by the summed axial length of the elements, no intermediate states are produced
+    """
+    def __init__(self, elements, SYS = None):
+        """
+        :param SYS: product of the element matrices if it's already known
+        """
+        if SYS is None:
+            SYS = elements[0].SYS
+            for element in elements[1:]:
+                SYS = element.SYS @ SYS
+
+        A, B, C, D = np.moveaxis(SYS.reshape(SYS.shape[:-2] + (4,)), -1, 0)
+        super().__init__(A=A, B=B, C=C, D=D, loc=elements[0].z)
+
+        self.elements = elements
+        self.dz = sum(element.dz for element in elements)
+
+    def __repr__(self):
+        return f"Composite of {len(self.elements)} elements: [{self.A}, {self.B}];[{self.C}, {self.D}]"
+
+    def plot(self, ax, ylims):
+        for element in self.elements:
+            element.plot(ax, ylims)
+
+
+def compacting(rays, steps, compact, profiler = None, label = None):
+    """
+    Applies the steps of a trace to a RayArray of lin2d or lin4d rays
+    Once fewer than compact of the working rays are live after a step that can stop rays, the later steps only work
+    on a copy of the live rays, which is put back at the end
+    :param steps: iterable of (function applied to the working rays, index recorded in halted_at by the rays it stops,
+                  None for steps that can't stop rays)
+    :param label: function of the step index returning the name the profiler records it under
+    :return: the traced RayArray
+    """
+    work, idx = rays, None  # rays the steps are applied to and their indices in rays once compacted
+    for i, (apply, index) in enumerate(steps):
+        if profiler is None:
+            apply(work)
+        else:
+            profiler.call(label(i), apply, work)
+
+        if index is None:
+            continue
+
+        stopped = work.halt & (work.halted_at < 0)
+        work.halted_at[stopped] = index
+
+        # swept (K, N) bundles broadcast against the swept elements, so only 1d bundles are compacted
+        if rays.halt.ndim == 1 and len(work) - np.count_nonzero(work.halt) < compact * len(work):
+            live = np.flatnonzero(~work.halt)
+            if idx is not None:
+                rays.put(idx, work)
+                live = idx[live]
+            work, idx = rays.take(live), live
+
+    if idx is not None:
+        rays.put(idx, work)
+
+    return rays
 
 
 class OpticsSystem(list):
@@ -138,6 +341,8 @@ class OpticsSystem(list):
     Define an optical system using a list of elements
     Distances between elements are found, and distance elements don't need to be added
     """
+    profiler = None  # set to a profiling.Profiler to record every element the trace loops apply
+
     def __init__(self, element_list, propagate = 0):
         super().__init__(element_list)
 
@@ -149,9 +354,44 @@ class OpticsSystem(list):
             self.insert(1 + 2*i, dist) # Inserts distances between elements
         self.append(Distance(propagate))
 
-        self.SYS = self[0].SYS
-        for element in self[1:]:
-            self.SYS = element.SYS @ self.SYS
+        self.tree = MatrixTree([element.SYS for element in self])
+        self._segments = None
+
+    @property
+    def SYS(self):
+        return self.tree.product()
+
+    def subsystem(self, start = 0, stop = None):
+        """:return: matrix of the elements start to stop of the system"""
+        return self.tree.product(start, stop)
+
+    def update(self, element, **params):
+        """
+        Changes parameters of one element of the system in place, e.g. system.update(lens, f=40, z=12)
+        Only the distances around it, the matrix products containing it and its fused segment are recomputed
+        :param element: element of the system or its index
+        """
+        index = element if isinstance(element, int) else [id(e) for e in self].index(id(element))
+        element = self[index]
+        element.update(**params)
+
+        changed = [index]
+        if not isinstance(element, Distance):
+            if index > 0:
+                prev_element = self[index - 2]
+                self[index - 1].update(dz=element.z - (prev_element.z + prev_element.B))
+                changed.append(index - 1)
+            if index + 2 < len(self):
+                next_element = self[index + 2]
+                self[index + 1].update(dz=next_element.z - (element.z + element.B))
+                changed.append(index + 1)
+
+        for i in changed:
+            self.tree[i] = self[i].SYS
+
+            if self._segments is not None:
+                seg = bisect.bisect_right(self._spans, (i, np.inf)) - 1
+                self._segments[seg] = self.segment(*self._spans[seg])
 
     def __repr__(self):
         rep = ''
@@ -160,15 +400,158 @@ class OpticsSystem(list):
 
         return rep
 
-    def calcPath(self, ray, first_element = 0):
+    def segments(self):
+        """
+        Folds every run of linear elements between nonlinear ones (Stop, ThinLensMLA) into a Composite
+        :return: list of Composite and nonlinear elements, equivalent to the full system
+        """
+        if self._segments is None:
+            self._spans, start = [], 0  # (start, stop) indices of every segment
+            for i, element in enumerate(self):
+                if element.linear:
+                    continue
+                if i > start:
+                    self._spans.append((start, i))
+                self._spans.append((i, i + 1))
+                start = i + 1
+            if start < len(self):
+                self._spans.append((start, len(self)))
+
+            self._segments = [self.segment(start, stop) for start, stop in self._spans]
+
+        return self._segments
+
+    def segment(self, start, stop):
+        """:return: the nonlinear element at start or a Composite of the linear elements start to stop"""
+        if not self[start].linear:
+            return self[start]
+        return Composite(self[start:stop], SYS=self.subsystem(start, stop))
+
+    def label(self, index, fused = False):
+        """:return: name the profiler records an element or fused segment under, its indices and type"""
+        start, stop = self._spans[index] if fused else (index, index + 1)
+        element = self.segments()[index] if fused else self[index]
+        span = f"{start}" if stop == start + 1 else f"{start}:{stop}"
+        return f"{span} {type(element).__name__}"
+
+    def calcPath(self, ray, first_element = 0, fused = False):
+        """
+        Stops at the element that halts the ray, its index is kept in ray.halted_at
+        :param fused: apply the precomposed segments instead of every element,
+                      only the states between segments are recorded
+        """
+        if ray.halt:
+            return
+
+        if getattr(ray, 'history', None) is not None:
+            ray.history.reserve(ray.history.n_steps + len(self) + 1)
+
         dobj = Distance(self[0].z - ray.z)
         dobj @ ray
 
-        for element in self:
-            element @ ray
+        for i, element in enumerate(self.segments() if fused else self):
+            if self.profiler is None:
+                element @ ray
+            else:
+                self.profiler.call(self.label(i, fused), element.__matmul__, ray)
+
+            if ray.halt:
+                ray.halted_at = self._spans[i][0] if fused else i
+                break
+
+    def trace(self, rays, fused = False, compact = .5):
+        """
+        Vectorized equivalent of calcPath, every element is applied to the whole bundle at once
+        The index of the element that stopped each ray is kept in rays.halted_at
+        :param rays: RayArray, updated in place
+        :param fused: apply the precomposed segments instead of every element,
+                      use when only the final state is needed
+        :param compact: once fewer than this fraction of the working rays are live after a nonlinear element,
+                        the later elements only work on a copy of the live rays, 0 never compacts
+        :return: the traced RayArray
+        """
+        if rays.history is not None:
+            rays.history.reserve(rays.history.n_steps + len(self) + 1)
+
+        dz = expand(self[0].z) - rays.z
+        np.add(rays.z, dz, out=rays.z, where=~rays.halt)
+        rays.rt = rays.rt + np.stack([dz * rays.rt[..., 1], np.zeros_like(dz)], axis=-1)
+
+        steps = ((element.Batch, None if element.linear else self._spans[i][0] if fused else i)
+                 for i, element in enumerate(self.segments() if fused else self))
+        return compacting(rays, steps, compact, self.profiler, lambda i: self.label(i, fused))
+
+    def sweep(self, rays, params, fused = True):
+        """
+        Traces a bundle through K variations of the system at once
+        The swept elements get (K, 2, 2) stacks of matrices and the rays are broadcast to (K, N)
+        :param rays: RayArray or Bundle of N rays, left unchanged
+        :param params: dict mapping elements of the system to dicts of parameter arrays of length K
+                       e.g. {lens: {'f': f_values}, window: {'z': z_values, 'n2': n_values}}
+        :param fused: trace through the precomposed segments
+        :return: RayArray of shape (K, N) with the final state of every ray in every configuration
+        """
+        if hasattr(rays, 'asArray'):
+            rays = rays.asArray()
+
+        # the distances are rebuilt from the element positions, so only the defined elements are copied
+        elements = []
+        for element in self[0::2]:
+            if element in params:
+                swept = copy.copy(element)
+                swept.update(**params[element])
+                element = swept
+            elements.append(element)
+
+        system = OpticsSystem(elements, propagate=self[-1].dz)
+        system.profiler = self.profiler
+
+        K = np.broadcast_shapes(*[np.shape(value) for values in params.values() for value in values.values()])
+        swept = RayArray(np.broadcast_to(rays.rt[..., 1], K + rays.halt.shape), rays.rt[..., 0], z=rays.z,
+                         n_current=rays.n, color=rays.color, history=False)
+        swept.halt |= rays.halt
+
+        return system.trace(swept, fused=fused)
+
+    def stream(self, source, chunk_size = 2**16, fused = True):
+        """
+        Traces a source one fixed-size chunk at a time, peak memory is bounded by chunk_size
+        :param source: Bundle, RayArray or an iterable of Paths or RayArray chunks
+        :param chunk_size: number of rays traced together
+        :param fused: trace each chunk through the precomposed segments
+        :return: generator of traced RayArray chunks, without history
+        """
+        for chunk in chunks(source, chunk_size):
+            yield self.trace(chunk, fused=fused)
+
+    def accumulate(self, source, consumer, chunk_size = 2**16, fused = True):
+        """
+        Streams a source through the system straight into a consumer such as sensors.Image
+        :param consumer: object that takes each traced chunk with consumer + chunk
+        :return: the consumer
+        """
+        for chunk in self.stream(source, chunk_size=chunk_size, fused=fused):
+            consumer + chunk
+
+        return consumer
+
+    def zstack(self, source, stack, chunk_size = 2**16, fused = True):
+        """
+        Traces a source once to the end of the last element and images it at every plane of a sensors.ZStack,
+        the distances of the stack take the place of the propagate distance of the system
+        :return: the stack
+        """
+        system = OpticsSystem(self[0::2], propagate=0)
+        system.profiler = self.profiler
+
+        return system.accumulate(source, stack, chunk_size=chunk_size, fused=fused)
 
     def __matmul__(self, rays):
-        if hasattr(rays, '__iter__'):
+        if isinstance(rays, RayArray):
+            self.trace(rays)
+        elif hasattr(rays, 'asArray'):
+            self.trace(rays.asArray())
+        elif hasattr(rays, '__iter__'):
             for ray in rays:
                 self.calcPath(ray)
         else: self.calcPath(rays)
@@ -189,7 +572,7 @@ class OpticsSystem(list):
             elem.plot(ax, ylims)
 
 
-class Bundle:
+class Bundle(ABC):
 
     @staticmethod
     def getCmap(color, MPL_grades=11):
@@ -206,16 +589,53 @@ class Bundle:
 
         return cmap
 
-    def __init__(self, num, color):
-        self.bundle = []
+    @staticmethod
+    def getColors(color, num, MPL_grades=11, start=0, stop=None):
+        """
+        Vectorized getCmap, the colormap is sampled for every ray at once
+        :param start, stop: only give the colors of rays start to stop
+        :return: (stop - start, 3) unsigned 8 bit integer array of red green and blue values
+        """
+        return Bundle.colorsAt(color, np.arange(*slice(start, stop).indices(num)) / num, MPL_grades)
+
+    @staticmethod
+    def colorsAt(color, x, MPL_grades=11):
+        """
+        :param x: array of positions in [0, 1) along the colormap
+        :return: (len(x), 3) unsigned 8 bit integer array of red green and blue values
+        """
+        if callable(color):
+            return np.array([hex2rgb(color(xi)) for xi in x], dtype=np.uint8).reshape(len(x), 3)
+        elif color[0] == '#':
+            return np.tile(hex2rgb(color), (len(x), 1))
+        else:
+            mpl_cmap = get_cmap(color, MPL_grades)
+            lut = (255 * mpl_cmap(np.arange(MPL_grades))[:, :3]).astype(np.uint8)
+            # same binning matplotlib uses for float inputs, done once per bundle instead of per ray
+            return np.take(lut, np.minimum((x * MPL_grades).astype(np.intp), MPL_grades - 1), axis=0)
+
+    def __init__(self, num, color, history = True, sampling = 'grid', seed = None):
+        """
+        :param sampling: how the ray parameters are spread over their ranges, one of sampling.KINDS
+        :param seed: seed of random, stratified and randomized quasi-random sampling
+        """
         self.num = num
-        self.cmap = self.getCmap(color)
+        self.color = color
+        self.history = history
+        self.sampling = sampling
+        self.seed = seed
+        self.state = None  # RayArray of the bundle, only built when it's first needed
+
+    @cached_property
+    def colors(self):
+        return self.getColors(self.color, self.num)
 
     def __len__(self):
         return self.num
 
     def __getitem__(self, item):
-        return self.bundle[item]
+        """:return: PathView of ray item, tracing it with calcPath traces that ray of the bundle in place"""
+        return self.asArray().view(item)
 
     def __iter__(self):
         self.ii = 0
@@ -232,14 +652,78 @@ class Bundle:
     def __repr__(self):
         return type(self).__name__
 
-    def plot(self, ax, kwargs = {}):
-        for ray in self.bundle:
-            ray.plot(ax, kwargs)
+    def __getstate__(self):
+        # cached parameter and color arrays are rebuilt on demand, they don't need to be pickled
+        state = self.__dict__.copy()
+        for name in ('colors', 'r_array', 't_array'):
+            state.pop(name, None)
+        return state
+
+    @abstractmethod
+    def sample(self, start = 0, stop = None, history = None):
+        """
+        Builds the rays of the source from its parameters, defined by each source
+        :param history: record the states of the rays, defaults to the history setting of the bundle
+        :return: RayArray of rays start to stop
+        """
+
+    def grid(self, lo, hi, start = 0, stop = None):
+        """
+        Elements start to stop of np.linspace(lo, hi, num) computed without building the whole grid
+        """
+        ii = np.arange(*slice(start, stop).indices(self.num))
+        if self.num == 1:
+            return np.full(len(ii), lo, dtype=np.float64)
+
+        values = ii * ((hi - lo) / (self.num - 1)) + lo
+        values[ii == self.num - 1] = hi
+
+        return values
+
+    def spread(self, lo, hi, start = 0, stop = None, dim = 1):
+        """
+        Values of rays start to stop spread over lo to hi with the sampling of the bundle
+        :param lo, hi: scalars, or (dim,) arrays of the bounds of each parameter
+        :return: (stop - start,) array, or (stop - start, dim) for more than one parameter
+        """
+        if self.sampling == 'grid' and dim == 1:
+            return self.grid(lo, hi, start, stop)
+
+        u = unit(self.sampling, self.num, dim, start, stop, seed=self.seed)
+        values = np.asarray(lo) + u * (np.asarray(hi) - np.asarray(lo))
+        return values[:, 0] if dim == 1 else values
+
+    def sampleColors(self, start = 0, stop = None, x = None):
+        """
+        :param x: position in [0, 1] of rays start to stop in the range of the source, off the grid rays are colored
+                  by where they land rather than by their index
+        :return: (stop - start, 3) unsigned 8 bit integer array of the ray colors
+        """
+        if self.sampling != 'grid' and x is not None:
+            return self.colorsAt(self.color, x)
+        if 'colors' in self.__dict__:
+            return self.colors[start:stop]
+        return self.getColors(self.color, self.num, start=start, stop=stop)
+
+    def asArray(self):
+        """
+        :return: RayArray holding the state of the bundle, OpticsSystem @ bundle traces it in place
+        """
+        if self.state is None:
+            self.state = self.sample()
+        return self.state
+
+    def plot(self, ax, kwargs = {}, max_rays = None):
+        """
+        Draws the traced bundle as a single LineCollection
+        :param max_rays: display budget, evenly spaced rays are drawn when there are more rays than this
+        """
+        return self.asArray().plot(ax, kwargs, max_rays=max_rays)
 
 
 class CollimatedSource(Bundle):
     def __init__(self, r_max, r_min = None, num = 51, zstart = -100, theta = 0, n_ior = 1,
-                 color = 'viridis'):
+                 color = 'viridis', history = True, sampling = 'grid', seed = None):
         """
         :param r_max: maximum height of collimated source
         :param r_min: minimum height of collimated source
@@ -248,8 +732,10 @@ class CollimatedSource(Bundle):
         :param zstart: axial position of source, default = -100
         :param theta:  angle in radians of the light source
         :param n_ior: starting index of refraction
+        :param history: record the states of the rays when traced
+        :param sampling: 'grid', 'stratified', 'random', 'halton' or 'sobol' spacing of the heights
         """
-        super().__init__(num, color)
+        super().__init__(num, color, history=history, sampling=sampling, seed=seed)
 
         self.z = zstart
         self.n_ior = n_ior
@@ -260,18 +746,35 @@ class CollimatedSource(Bundle):
         else:
             self.r_min = r_min
 
-        self.r_array = np.linspace(self.r_min, self.r_max, self.num)
+    @cached_property
+    def r_array(self):
+        return self.spread(self.r_min, self.r_max)
+
+    @property
+    def bounds(self):
+        """:return: range of the ray heights, the parameter the source is sampled over"""
+        return self.r_min, self.r_max
 
-        for ii, r in enumerate(self.r_array):
+    def at(self, r, colors = None, history = False):
+        """
+        :param r: array of ray heights
+        :param colors: (N, 3) array of ray colors, by default the colormap at the position of r in its range
+        :return: RayArray of the rays of the source at the heights r
+        """
+        if colors is None:
+            colors = self.colorsAt(self.color, (r - self.r_min) / (self.r_max - self.r_min))
+        return RayArray(self.t, r, z=self.z, n_current=self.n_ior, color=colors, history=history)
 
-            c_hex = self.cmap(ii / self.num)
-            self.bundle.append(Path(self.t, r, z = self.z, n_current=self.n_ior, color= c_hex))
+    def sample(self, start = 0, stop = None, history = None):
+        history = self.history if history is None else history
+        r = self.spread(self.r_min, self.r_max, start, stop)
+        return self.at(r, self.sampleColors(start, stop, (r - self.r_min) / (self.r_max - self.r_min)), history)
 
 
 class PointSource(Bundle):
     def __init__(self, z, r, theta_max, theta_min = None, num = 51, n_ior = 1,
-                 color = '#FF0000'):
-        super().__init__(num, color)
+                 color = '#FF0000', history = True, sampling = 'grid', seed = None):
+        super().__init__(num, color, history=history, sampling=sampling, seed=seed)
 
         self.z = z
         self.r = r
@@ -281,15 +784,50 @@ class PointSource(Bundle):
         else:
             self.t_min = theta_min
         self.n_ior = n_ior
-        self.color = color
 
-        self.t_array = np.linspace(self.t_min, self.t_max, self.num)
-        for ii, t in enumerate(self.t_array):
-            c_hex = self.cmap(ii / self.num)
-            self.bundle.append(Path(t, self.r, z=self.z, n_current=self.n_ior, color=c_hex))
+    @cached_property
+    def t_array(self):
+        return self.spread(self.t_min, self.t_max)
 
-    def __getitem__(self, item):
-        return self.bundle[item]
+    @property
+    def bounds(self):
+        """:return: range of the ray angles, the parameter the source is sampled over"""
+        return self.t_min, self.t_max
 
-    def __len__(self):
-        return self.num
\ No newline at end of file
+    def at(self, t, colors = None, history = False):
+        """
+        :param t: array of ray angles
+        :param colors: (N, 3) array of ray colors, by default the colormap at the position of t in its range
+        :return: RayArray of the rays of the source at the angles t
+        """
+        if colors is None:
+            colors = self.colorsAt(self.color, (t - self.t_min) / (self.t_max - self.t_min))
+        return RayArray(t, self.r, z=self.z, n_current=self.n_ior, color=colors, history=history)
+
+    def sample(self, start = 0, stop = None, history = None):
+        history = self.history if history is None else history
+        t = self.spread(self.t_min, self.t_max, start, stop)
+        return self.at(t, self.sampleColors(start, stop, (t - self.t_min) / (self.t_max - self.t_min)), history)
+
+
+class ExtendedSource(Bundle):
+    def __init__(self, z, r_max, theta_max, r_min = None, theta_min = None, num = 1024, n_ior = 1,
+                 color = '#FF0000', history = True, sampling = 'sobol', seed = None):
+        """
+        Source filling a range of heights and angles at once, both are sampled jointly in 2D
+        :param r_min, theta_min: if not given the opposite of r_max and theta_max are used
+        :param sampling: 'stratified', 'random', 'halton' or 'sobol', grid sampling is 1D only
+        """
+        super().__init__(num, color, history=history, sampling=sampling, seed=seed)
+
+        self.z = z
+        self.r_max, self.t_max = r_max, theta_max
+        self.r_min = -r_max if r_min is None else r_min
+        self.t_min = -theta_max if theta_min is None else theta_min
+        self.n_ior = n_ior
+
+    def sample(self, start = 0, stop = None, history = None):
+        history = self.history if history is None else history
+        r, t = self.spread((self.r_min, self.t_min), (self.r_max, self.t_max), start, stop, dim=2).T
+        colors = self.sampleColors(start, stop, (r - self.r_min) / (self.r_max - self.r_min))
+        return RayArray(t, r, z=self.z, n_current=self.n_ior, color=colors, history=history)
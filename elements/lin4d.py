@@ -1,8 +1,12 @@
 import numpy as np
-import lin2d
-from ..rays.rays4d import Ray, Path
+from functools import lru_cache
+from . import lin2d
+from ..rays.rays4d import Ray, Path, RayArray
+from ..sampling import disc
 
 class mat4d():
+    halts = False  # elements that can stop rays set this to True
+
     def __init__(self, z: float, n : float = 1):
         self.SYS = np.identity(6, dtype=np.float64)
         self.z = z
@@ -14,14 +18,23 @@ class mat4d():
     def Tform(self, path: Path):
         if self.TformCondition(path):
             new_state = self.SYS @ path.state
-            return Ray(*new_state, n=self.n, color=path.color)
+            return Ray.fromState(new_state, n=self.n, color=path.color)
 
     def TformCondition(self, _: Path):
         return True
 
+    def TformBatch(self, rays: RayArray):
+        """Applies the element to every ray of a RayArray in one operation"""
+        self.TformConditionBatch(rays)
+        rays.state = rays.state @ self.SYS.T
+
+    def TformConditionBatch(self, rays: RayArray):
+        """Sets the halt mask of the rays the element stops"""
+        pass
+
 class ABCD4d(mat4d):
     def __init__(self, sys2d: lin2d.ABCD):
-        super().__init__(self, sys2d.z)
+        super().__init__(sys2d.z)
         self.set_ABCD(sys2d.SYS)
 
     def set_ABCD(self, sys2d_mat):
@@ -33,7 +46,7 @@ class ABCD4d(mat4d):
         self.SYS[:2,:2] = sys2d_mat
 
     def set_ABCD2(self, sys2d_mat):
-        self.SYS[2:5, 2:5] = sys2d_mat
+        self.SYS[2:4, 2:4] = sys2d_mat
 
 
 
@@ -58,12 +71,14 @@ class Prism(mat4d):
 
 
 class StopCirc(mat4d):
+    halts = True
+
     def __init__(self, r, loc=None):
         super().__init__(loc)
         self.R2 = r**2
 
     def TformCondition(self, path: Path):
-        x, y, _, _ = path.state
+        x, _, y = path.state[:3]
         r = x**2 + y**2
         if r > self.R2:
             path.halt = True
@@ -71,8 +86,133 @@ class StopCirc(mat4d):
         else:
             return True
 
+    def TformConditionBatch(self, rays: RayArray):
+        x, y = rays.state[..., 0], rays.state[..., 2]
+        rays.halt |= x**2 + y**2 > self.R2
+
+@lru_cache(maxsize=64)
+def lattice_centers(pitch, diameter, pattern):
+    """
+    Lenslet centers of a 'hex' or 'rect' microlens array, cached so arrays with the same layout share them
+    Rows are p*cos(30) apart for 'hex' with every other row shifted by half a pitch
+    :return: read-only (M, 2) array of x, y centers
+    """
+    r_limit = (diameter + pitch) / 2
+    h = np.cos(np.deg2rad(30))*pitch if pattern == 'hex' else pitch
+
+    n_rows, n_cols = int(r_limit // h) + 1, int(r_limit // pitch) + 2
+    j, i = np.meshgrid(np.arange(-n_rows, n_rows + 1), np.arange(-n_cols, n_cols + 1), indexing='ij')
+
+    y = j * h
+    x = i * pitch
+    if pattern == 'hex':
+        x = x + .5*pitch*(j % 2)
+
+    inside = (np.abs(y) < r_limit) & (x**2 + y**2 < r_limit**2)
+    centers = np.stack([x[inside], y[inside]], axis=-1)
+    centers.flags.writeable = False
+    return centers
+
+
+def kdtree(centers):
+    """:return: scipy cKDTree of the centers, imported only when needed, or False if scipy isn't installed"""
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:  # the grid hash falls back to a blocked full search
+        return False
+    return cKDTree(centers)
+
+
+class CenterGrid:
+    """
+    Grid hash of arbitrary lenslet centers for nearest-center lookup
+    Each ray only checks the centers in the 3x3 cells around it, rays with no center close enough fall back to
+    a KD-tree when scipy is installed or a full search otherwise
+    """
+    neighbours = np.array([(di, dj) for di in (-1, 0, 1) for dj in (-1, 0, 1)])
+
+    def __init__(self, centers, cell = None):
+        self.centers = np.asarray(centers, dtype=np.float64)
+        if cell is None:
+            # about one center per cell on average
+            extent = np.ptp(self.centers, axis=0).prod()
+            cell = np.sqrt(extent / len(self.centers)) if extent > 0 else 1.0
+        self.cell = cell
+
+        ij = np.floor(self.centers / cell).astype(np.int64)
+        self.offset = ij.min(axis=0) - 1
+        self.shape = ij.max(axis=0) - self.offset + 2
+        keys = self.key(ij)
+
+        # centers sorted by cell, the centers of cell k are order[cell_start[k]:cell_start[k + 1]]
+        self.order = np.argsort(keys, kind='stable')
+        self.cell_start = np.concatenate([[0], np.cumsum(np.bincount(keys, minlength=self.shape.prod()))])
+        self.tree = None
+
+    def key(self, ij):
+        ij = np.clip(ij - self.offset, 0, self.shape - 1)
+        return ij[..., 0] * self.shape[1] + ij[..., 1]
+
+    def nearest(self, x, y, block = 2**18):
+        """:return: index of the center closest to each ray"""
+        pos = np.stack([np.ravel(x), np.ravel(y)], axis=-1)
+        lens_idx = np.zeros(len(pos), dtype=np.intp)
+        best = np.full(len(pos), np.inf)
+
+        for start in range(0, len(pos), block):
+            rows = slice(start, start + block)
+            lens_idx[rows], best[rows] = self.search(pos[rows])
+
+        # anything further than one cell away could have a closer center outside the 3x3 block
+        far = np.flatnonzero(best > self.cell**2)
+        if len(far) and self.tree is None:
+            self.tree = kdtree(self.centers)
+        if len(far) and self.tree is not False:
+            lens_idx[far] = self.tree.query(pos[far])[1]
+            return lens_idx
+
+        # |c|^2 - 2 p.c orders the centers the same as the distance, and the product runs as a matrix multiply
+        norm2 = (self.centers**2).sum(axis=-1)
+        step = max(1, 2**22 // len(self.centers))
+        for start in range(0, len(far), step):
+            rows = far[start:start+step]
+            lens_idx[rows] = (norm2 - 2 * pos[rows] @ self.centers.T).argmin(axis=1)
+
+        return lens_idx
+
+    def search(self, pos):
+        """Checks every center in the 3x3 cells around each position at once"""
+        ij = np.floor(pos / self.cell).astype(np.int64)
+        keys = self.key(ij[:, None, :] + self.neighbours).ravel()
+
+        starts = self.cell_start[keys]
+        counts = self.cell_start[keys + 1] - starts
+
+        # one entry per (ray, candidate center) pair, grouped by ray
+        ends = np.cumsum(counts)
+        pair = np.arange(ends[-1] if len(ends) else 0)
+        cand = self.order[pair - np.repeat(ends - counts - starts, counts)]
+        ray = np.repeat(np.arange(len(keys)) // len(self.neighbours), counts)
+        d2 = ((pos[ray] - self.centers[cand])**2).sum(axis=-1)
+
+        per_ray = counts.reshape(len(pos), -1).sum(axis=1)
+        found = per_ray > 0
+        best = np.full(len(pos), np.inf)
+        best[found] = np.minimum.reduceat(d2, (np.cumsum(per_ray) - per_ray)[found])
+
+        lens_idx = np.zeros(len(pos), dtype=np.intp)
+        hit = d2 == best[ray]
+        lens_idx[ray[hit]] = cand[hit]
+
+        return lens_idx, best
+
+
 class ThinLensMLA(ThinLens):
-    def __init__(self, f, pitch, d, pattern: str,  loc: np.float64):
+    def __init__(self, f, pitch, d, pattern: str,  loc: np.float64, centers = None):
+        """
+        :param pattern: 'hex' or 'rect' lattice, or 'custom' to use the given centers
+        :param centers: (M, 2) array of lenslet centers for the 'custom' pattern
+        """
         super().__init__(f, d, loc=loc)
         self.p = pitch
         self.pattern = pattern
@@ -81,62 +221,265 @@ class ThinLensMLA(ThinLens):
             self.hex_centers()
         elif pattern == 'rect':
             self.rect_centers()
+        elif pattern == 'custom' and centers is not None:
+            self.centers = np.asarray(centers, dtype=np.float64)
         else:
             raise ValueError("Invalid Pattern")
 
-    def hex_centers(self):
-        r_limit = (self.d + self.p) / 2
-        y, x = 0, 0
-
-        centers = []
-
-        ii = 0
-        while y < r_limit:
-            while (x**2 + y**2) < r_limit**2:
-                centers.append(( x,  y))
-                centers.append((-x, -y))
-                centers.append((-x,  y))
-                centers.append(( x, -y))
-                x += self.p
-
-            y += np.cos(np.deg2rad(30))*self.pitch
-            if ii % 2:
-                x = .5*self.p
-            else:
-                x = 0
+        if pattern == 'custom':
+            self.rim = np.arange(len(self.centers))
+        else:
+            # the closest lenslet to a ray outside of the lattice is always within two pitches of its edge
+            r_limit = (self.d + self.p) / 2
+            self.rim = np.flatnonzero(np.hypot(*self.centers.T) > r_limit - 2*self.p)
+        self.grid = CenterGrid(self.centers[self.rim])
 
-        self.centers = np.array(centers)
+    def hex_centers(self):
+        self.centers = lattice_centers(self.p, self.d, 'hex')
 
     def rect_centers(self):
-        r_limit = (self.d + self.p) / 2
-        y, x = 0, 0
-
-        centers = []
-
-
-        while y < r_limit:
-            while (x ** 2 + y ** 2) < r_limit ** 2:
-                centers.append((x, y))
-                centers.append((-x, -y))
-                centers.append((-x, y))
-                centers.append((x, -y))
-                x += self.p
-
-            y += self.pitch
-            x = 0
-
-        self.centers = np.array(centers)
+        self.centers = lattice_centers(self.p, self.d, 'rect')
 
     def Tform(self, path: Path):
         if self.TformCondition(path):
-            #              ray x        lenslet x
-            lens_idx = ((path.state[0] - self.centers[:,0])**2 + (path.state[1] - self.centers[:,2])**2).argmin()
-            sx, sy = self.centers[lens_idx] # shift x , shift y
+            sx, sy = self.lenslets(path.state[0:1], path.state[2:3])[0] # shift x , shift y
+
+            new_state = self.SYS @ path.state + np.array([0, sx / self.f, 0, sy/self.f, 0, 0])
+            return Ray.fromState(new_state, n=self.n, color=path.color)
+
+    def lenslets(self, x, y):
+        """
+        Finds the lenslet of each ray directly from the lattice for 'rect' and 'hex' patterns,
+        rays outside of the populated lattice and 'custom' patterns use the grid hash
+        :return: (N, 2) array of the center of the lenslet closest to each ray
+        """
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        if self.pattern == 'custom':
+            return self.centers[self.grid.nearest(x, y)]
+
+        if self.pattern == 'rect':
+            cx, cy = np.around(x / self.p) * self.p, np.around(y / self.p) * self.p
+        else:
+            # rows are p*cos(30) apart and every other row is shifted by half a pitch, check the two closest rows
+            h = np.cos(np.deg2rad(30)) * self.p
+            row = np.floor(y / h)
+            best = np.full(x.shape, np.inf)
+            cx, cy = np.empty(x.shape), np.empty(x.shape)
+            for j in (row, row + 1):
+                shift = .5 * self.p * (j % 2)
+                jx = np.around((x - shift) / self.p) * self.p + shift
+                d2 = (x - jx)**2 + (y - j*h)**2
+                closer = d2 < best
+                best[closer] = d2[closer]
+                cx[closer], cy[closer] = jx[closer], j[closer] * h
+
+        centers = np.stack([cx, cy], axis=-1)
 
+        r_limit = (self.d + self.p) / 2
+        outside = np.flatnonzero(cx**2 + cy**2 >= r_limit**2)
+        if len(outside):
+            centers[outside] = self.centers[self.rim[self.grid.nearest(x[outside], y[outside])]]
+
+        return centers
+
+    def TformBatch(self, rays: RayArray):
+        self.TformConditionBatch(rays)
+
+        centers = self.lenslets(rays.state[..., 0], rays.state[..., 2])
+        shift = np.zeros(rays.state.shape)
+        shift[..., 1] = centers[..., 0] / self.f
+        shift[..., 3] = centers[..., 1] / self.f
+
+        rays.state = rays.state @ self.SYS.T + shift
+
+
+def step(path: Path, element):
+    """Applies element.Tform to a path, stopped paths are left as they are"""
+    ray = element.Tform(path)
+    if ray is not None:
+        path.state = ray
+
+
+class OpticsSystem(list):
+    """
+    Define a 4D optical system using a list of elements
+    Distances between elements are found, and distance elements don't need to be added
+    """
+    profiler = None  # set to a profiling.Profiler to record every element the trace loops apply
+
+    def __init__(self, element_list, propagate = 0):
+        super().__init__(element_list)
+
+        # Add a distance element to the system between defined elements using the difference in z positions
+        for i, (prev_element, next_element) in enumerate(zip(self[:-1],self[1:])):
+            dz = next_element.z - (prev_element.z + prev_element.SYS[4, 5])
+            self.insert(1 + 2*i, Distance(dz))
+        self.append(Distance(propagate))
+
+        self.SYS = self[0].SYS
+        for element in self[1:]:
+            self.SYS = element.SYS @ self.SYS
+
+    def __repr__(self):
+        rep = ''
+        for element in self:
+            rep += f" -> {type(element).__name__}"
+
+        return rep
+
+    def trace(self, rays: RayArray, compact = .5):
+        """
+        Applies every element to the whole bundle at once
+        The index of the element that stopped each ray is kept in rays.halted_at
+        :param rays: RayArray, updated in place
+        :param compact: once fewer than this fraction of the working rays are live after a stop,
+                        the later elements only work on a copy of the live rays, 0 never compacts
+        :return: the traced RayArray
+        """
+        if rays.history is not None:
+            rays.history.reserve(rays.history.n_steps + len(self) + 1)
+
+        dz = self[0].z - rays.z
+        move = np.zeros(rays.state.shape)
+        move[..., 0] = dz * rays.state[..., 1]
+        move[..., 2] = dz * rays.state[..., 3]
+        move[..., 4] = dz
+        rays.state = rays.state + move
+
+        steps = ((element.TformBatch, i if element.halts else None) for i, element in enumerate(self))
+        return lin2d.compacting(rays, steps, compact, self.profiler, lambda i: f"{i} {type(self[i]).__name__}")
+
+    def calcPath(self, path: Path):
+        """
+        Applies the Tform of every element to a single Path, the scalar equivalent of trace
+        Stops at the element that halts the path, its index is kept in path.halted_at
+        :param path: rays4d.Path, updated in place
+        """
+        if path.halt:
+            return
+
+        dz = self[0].z - path.state[4]
+        path.state = path.state + dz * np.array([path.state[1], 0, path.state[3], 0, 1, 0])
+
+        for i, element in enumerate(self):
+            if self.profiler is None:
+                step(path, element)
+            else:
+                self.profiler.call(f"{i} {type(element).__name__}", step, path, element)
+
+            if path.halt:
+                path.halted_at = i
+                break
+
+    def stream(self, source, chunk_size = 2**16):
+        """
+        Traces a source one fixed-size chunk at a time, peak memory is bounded by chunk_size
+        :param source: RayArray, or a source with sample() such as a saved dataset.RayDataset
+        :return: generator of traced RayArray chunks, without history
+        """
+        for start in range(0, len(source), chunk_size):
+            if hasattr(source, 'sample'):
+                yield self.trace(source.sample(start, start + chunk_size, history=False))
+            else:
+                yield self.trace(source[start:start + chunk_size])
+
+    def accumulate(self, source, consumer, chunk_size = 2**16):
+        """
+        Streams a source through the system straight into a consumer such as sensors.Image2D
+        :param consumer: object that takes each traced chunk with consumer + chunk
+        :return: the consumer
+        """
+        for chunk in self.stream(source, chunk_size=chunk_size):
+            consumer + chunk
+
+        return consumer
+
+    def __matmul__(self, rays):
+        if hasattr(rays, 'asArray'):
+            return self.trace(rays.asArray())
+        return self.trace(rays)
+
+
+class Bundle(lin2d.Bundle):
+    """
+    4D source, the positions and angles of the rays are sampled over discs in (x, y) and (t, p)
+    Grid sampling is 1D only, so 4D sources default to sobol sampling
+    Colormaps run across the disc in x, or in t for point sources, every ray is colored by where it lands
+    """
+    def discs(self, radii, start = 0, stop = None):
+        """
+        :param radii: radius of every disc that is sampled jointly
+        :return: (stop - start, 2 * len(radii)) array of the x and y coordinates on each disc
+        """
+        u = self.spread(0, 1, start, stop, dim=2 * len(radii))
+        points = np.empty_like(u)
+        for i, radius in enumerate(radii):
+            points[:, 2*i], points[:, 2*i + 1] = disc(u[:, 2*i:2*i + 2])
+            points[:, 2*i:2*i + 2] *= radius
+
+        return points
+
+
+class CollimatedSource(Bundle):
+    def __init__(self, r_max, num = 1024, zstart = -100, theta = 0, phi = 0, x0 = 0, y0 = 0, n_ior = 1,
+                 color = 'viridis', history = True, sampling = 'sobol', seed = None):
+        """
+        :param r_max: radius of the disc filled by the collimated source
+        :param theta, phi: angles in radians of the light source in the x and y directions
+        :param x0, y0: center of the disc
+        :param sampling: 'stratified', 'random', 'halton' or 'sobol' sampling of the disc
+        """
+        super().__init__(num, color, history=history, sampling=sampling, seed=seed)
+
+        self.z = zstart
+        self.r_max = r_max
+        self.t, self.p = theta, phi
+        self.x0, self.y0 = x0, y0
+        self.n_ior = n_ior
+
+    def sample(self, start = 0, stop = None, history = None):
+        history = self.history if history is None else history
+        x, y = self.discs([self.r_max], start, stop).T
+        return RayArray(self.x0 + x, self.y0 + y, self.t, self.p, self.z, n=self.n_ior,
+                        color=self.sampleColors(start, stop, (x / self.r_max + 1) / 2), history=history)
+
+
+class PointSource(Bundle):
+    def __init__(self, z, theta_max, x = 0, y = 0, num = 1024, n_ior = 1,
+                 color = '#FF0000', history = True, sampling = 'sobol', seed = None):
+        """
+        :param theta_max: half angle in radians of the cone of rays
+        :param x, y: position of the point
+        """
+        super().__init__(num, color, history=history, sampling=sampling, seed=seed)
 
-            new_state = self.SYS @ path.state + np.array([0, sx / self.f, 0, sy/self.f, 0, 0, 0])
-            return Ray(*new_state, n=self.n, color=path.color)
+        self.z = z
+        self.x, self.y = x, y
+        self.t_max = theta_max
+        self.n_ior = n_ior
 
+    def sample(self, start = 0, stop = None, history = None):
+        history = self.history if history is None else history
+        t, p = self.discs([self.t_max], start, stop).T
+        return RayArray(self.x, self.y, t, p, self.z, n=self.n_ior,
+                        color=self.sampleColors(start, stop, (t / self.t_max + 1) / 2), history=history)
 
 
+class ExtendedSource(Bundle):
+    def __init__(self, z, r_max, theta_max, num = 4096, n_ior = 1,
+                 color = '#FF0000', history = True, sampling = 'sobol', seed = None):
+        """
+        Disc of radius r_max where every point emits a cone of half angle theta_max, sampled jointly in 4D
+        """
+        super().__init__(num, color, history=history, sampling=sampling, seed=seed)
 
+        self.z = z
+        self.r_max = r_max
+        self.t_max = theta_max
+        self.n_ior = n_ior
+
+    def sample(self, start = 0, stop = None, history = None):
+        history = self.history if history is None else history
+        x, y, t, p = self.discs([self.r_max, self.t_max], start, stop).T
+        colors = self.sampleColors(start, stop, (x / self.r_max + 1) / 2)
+        return RayArray(x, y, t, p, self.z, n=self.n_ior, color=colors, history=history)
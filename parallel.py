@@ -0,0 +1,146 @@
+import os
+import copy
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from .rays.rays2d import RayArray
+from .elements import lin2d
+
+
+class SharedRays:
+    """
+    State of a RayArray (rt, z, halt, color and halted_at) laid out in one shared memory block
+    Workers attach to the block by name, so no ray is pickled between processes
+    """
+
+    def __init__(self, num, name = None):
+        self.num = num
+        size = max(1, num * (2*8 + 8 + 1 + 3 + 4))
+
+        # only the creating process unlinks the block, workers just attach to it and close it
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+
+        buf = self.shm.buf
+        self.rt = np.ndarray((num, 2), dtype=np.float64, buffer=buf)
+        self.z = np.ndarray((num,), dtype=np.float64, buffer=buf, offset=16*num)
+        self.halt = np.ndarray((num,), dtype=bool, buffer=buf, offset=24*num)
+        self.color = np.ndarray((num, 3), dtype=np.uint8, buffer=buf, offset=25*num)
+        self.halted_at = np.ndarray((num,), dtype=np.int32, buffer=buf, offset=28*num)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def asArray(self, n_current = 1):
+        """:return: RayArray whose state arrays are views of the shared block"""
+        rays = RayArray.__new__(RayArray)
+        rays.n = n_current
+        rays.halt, rays.z, rays._rt, rays.color = self.halt, self.z, self.rt, self.color
+        rays.halted_at = self.halted_at
+        rays.history = None
+
+        return rays
+
+    def close(self):
+        # views have to be released before the buffer can be closed
+        del self.rt, self.z, self.halt, self.color, self.halted_at
+        self.shm.close()
+
+
+def blocks(num, n_blocks):
+    """Splits num rays into n_blocks contiguous (start, stop) ranges"""
+    edges = np.linspace(0, num, n_blocks + 1).astype(int)
+    return [(start, stop) for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+
+
+def partial(consumer):
+    """:return: copy of a consumer such as sensors.Image with an empty image"""
+    part = copy.copy(consumer)
+    part.img = np.zeros_like(consumer.img)
+    return part
+
+
+def trace(system, rays, consumer = None, workers = None, chunk_size = 2**16, fused = True):
+    """
+    Traces a RayArray or Bundle in place on a process pool
+    The rays are copied once into shared memory and each worker traces its own block of it
+    :param system: lin2d.OpticsSystem
+    :param rays: RayArray, or a Bundle whose state is traced
+    :param consumer: optional sensors.Image, the per-worker partial images are summed into it
+    :param workers: number of processes, defaults to the number of cpus
+    :return: the traced RayArray
+    """
+    if hasattr(rays, 'asArray'):
+        rays = rays.asArray()
+    workers = workers or os.cpu_count()
+
+    shared = SharedRays(len(rays))
+    try:
+        shared.rt[:], shared.z[:], shared.halt[:], shared.color[:] = rays.rt, rays.z, rays.halt, rays.color
+        shared.halted_at[:] = rays.halted_at
+
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_trace_block, system, shared.name, len(rays), start, stop,
+                                   consumer, chunk_size, fused, rays.n)
+                       for start, stop in blocks(len(rays), workers)]
+            images = [future.result() for future in futures]
+
+        # copied back through the setter, so the final state is recorded in the history like any other step
+        rays.z[:] = shared.z
+        rays.rt = shared.rt
+        rays.halt[:] = shared.halt
+        rays.halted_at[:] = shared.halted_at
+    finally:
+        shared.close()
+        shared.shm.unlink()
+
+    if consumer is not None:
+        consumer.img += sum(images)
+
+    return rays
+
+
+def accumulate(system, source, consumer, workers = None, chunk_size = 2**16, fused = True):
+    """
+    Parallel OpticsSystem.accumulate for sources built from parameters (CollimatedSource, PointSource, ExtendedSource)
+    Every worker samples and streams its own range of the source, only partial images are returned
+    Random and quasi-random samples are indexed by ray, so the image doesn't depend on the number of workers
+    :param system: lin2d or lin4d OpticsSystem, fused only applies to lin2d systems
+    :param consumer: sensor matching the system, e.g. sensors.Image or PhaseSpace for lin2d, Image2D or PhaseSpace4D
+    :return: the consumer
+    """
+    workers = workers or os.cpu_count()
+
+    source = copy.copy(source)
+    source.state = None  # the workers sample their rays, there's no need to send a traced state
+
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(_accumulate_block, system, source, start, stop, consumer, chunk_size, fused)
+                   for start, stop in blocks(len(source), workers)]
+        consumer.img += sum(future.result() for future in futures)
+
+    return consumer
+
+
+def _trace_block(system, name, num, start, stop, consumer, chunk_size, fused, n_current):
+    shared = SharedRays(num, name=name)
+    rays = shared.asArray(n_current)[start:stop]
+    try:
+        if consumer is None:
+            for _ in system.stream(rays, chunk_size=chunk_size, fused=fused):
+                pass
+            return 0
+
+        return system.accumulate(rays, partial(consumer), chunk_size=chunk_size, fused=fused).img
+    finally:
+        del rays
+        shared.close()
+
+
+def _accumulate_block(system, source, start, stop, consumer, chunk_size, fused):
+    part = partial(consumer)
+    for begin in range(start, stop, chunk_size):
+        chunk = source.sample(begin, min(begin + chunk_size, stop), history=False)
+        part + (system.trace(chunk, fused=fused) if isinstance(system, lin2d.OpticsSystem) else system.trace(chunk))
+
+    return part.img
@@ -0,0 +1,90 @@
+"""
+Opt-in per-element instrumentation of the trace loops
+Set system.profiler = Profiler() on a lin2d or lin4d OpticsSystem, the loops only check it against None otherwise
+"""
+
+import os
+import json
+import time
+import threading
+import numpy as np
+
+
+class Profiler:
+    """
+    Records the calls, wall time, rays processed and rays halted of every element a system applies
+    """
+    def __init__(self, events = True):
+        """
+        :param events: also keep every call as a timeline event for the Chrome trace
+        """
+        self.stats = {}
+        self.events = [] if events else None
+        self.start = time.perf_counter()
+
+    def reset(self):
+        self.stats.clear()
+        if self.events is not None:
+            self.events.clear()
+        self.start = time.perf_counter()
+
+    def call(self, label, method, rays, *args):
+        """
+        Calls method(rays, *args) and records it under label
+        :param rays: RayArray or Path, its halt mask is counted before and after the call
+        :return: what the method returns
+        """
+        size, halted = np.size(rays.halt), np.count_nonzero(rays.halt)
+
+        start = time.perf_counter()
+        out = method(rays, *args)
+        stop = time.perf_counter()
+
+        processed, halted = int(size - halted), int(np.count_nonzero(rays.halt) - halted)
+
+        stats = self.stats.get(label)
+        if stats is None:
+            stats = self.stats[label] = {'calls': 0, 'seconds': 0.0, 'rays': 0, 'halted': 0}
+        stats['calls'] += 1
+        stats['seconds'] += stop - start
+        stats['rays'] += processed
+        stats['halted'] += halted
+
+        if self.events is not None:
+            self.events.append((label, start, stop, processed, halted))
+
+        return out
+
+    def asDict(self):
+        """:return: dict of the totals of every element label, in the order they were first called"""
+        return {label: dict(stats) for label, stats in self.stats.items()}
+
+    def chromeTrace(self, file = None):
+        """
+        Timeline of every recorded call in the Chrome trace event format, viewable in chrome://tracing or Perfetto
+        :param file: optional path the JSON is written to
+        :return: dict of the trace
+        """
+        if self.events is None:
+            raise ValueError("Profiler was created with events=False")
+
+        pid, tid = os.getpid(), threading.get_ident()
+        trace = {'traceEvents': [{'name': label, 'ph': 'X', 'pid': pid, 'tid': tid,
+                                  'ts': 1e6 * (start - self.start), 'dur': 1e6 * (stop - start),
+                                  'args': {'rays': processed, 'halted': halted}}
+                                 for label, start, stop, processed, halted in self.events],
+                 'displayTimeUnit': 'ms'}
+
+        if file is not None:
+            with open(file, 'w') as f:
+                json.dump(trace, f)
+
+        return trace
+
+    def __repr__(self):
+        total = sum(stats['seconds'] for stats in self.stats.values()) or 1.0
+        rep = f"{'element':<24}{'calls':>8}{'seconds':>10}{'%':>7}{'rays':>12}{'halted':>10}"
+        for label, stats in sorted(self.stats.items(), key=lambda item: -item[1]['seconds']):
+            rep += (f"\n{label:<24}{stats['calls']:>8}{stats['seconds']:>10.4f}{100 * stats['seconds'] / total:>7.1f}"
+                    f"{stats['rays']:>12}{stats['halted']:>10}")
+        return rep
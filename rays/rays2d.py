@@ -1,5 +1,6 @@
+import copy
 import numpy as np
-from ..colors import rgb2hex, hex2rgb
+from ..colors import rgb2hex, rgb2hex8, hex2rgb
 
 class Ray:
 
@@ -18,16 +19,128 @@ class Ray:
     def get_rgb(self):
         return hex2rgb(self.color)
 
+class History:
+    """
+    Preallocated record of ray states in one contiguous (*shape, n_steps, width) buffer
+    The buffer doubles in length whenever it runs out of steps
+    """
+
+    rows = None  # steps recorded by every row once single rows were written with record, None when they all match
+
+    def __init__(self, shape = (), n_steps = 8, width = 3):
+        self.states = np.empty(tuple(shape) + (n_steps, width), dtype=np.float64)
+        self.n_steps = 0
+
+    def __len__(self):
+        return self.n_steps
+
+    def reserve(self, n_steps):
+        """Makes sure the buffer can hold n_steps states without reallocating"""
+        capacity = self.states.shape[-2]
+        if n_steps <= capacity:
+            return
+
+        grown = np.empty(self.states.shape[:-2] + (max(n_steps, 2*capacity), self.states.shape[-1]),
+                         dtype=np.float64)
+        grown[..., :self.n_steps, :] = self.states[..., :self.n_steps, :]
+        self.states = grown
+
+    def next(self):
+        """:return: writable view of the next state in the buffer"""
+        self.reserve(self.n_steps + 1)
+        self.n_steps += 1
+        self.rows = None
+        return self.states[..., self.n_steps - 1, :]
+
+    def record(self, row, state):
+        """
+        Writes the next state of a single row, such as one ray of a RayArray traced on its own
+        The other rows repeat their last state when the buffer needs a new step for it
+        """
+        rows = np.full(self.states.shape[:-2], self.n_steps, dtype=np.intp) if self.rows is None else self.rows
+        k = rows[row]
+        if k == self.n_steps:
+            step = self.next()
+            if k:
+                step[...] = self.states[..., k - 1, :]
+
+        self.states[row, k:self.n_steps] = state
+        rows[row] = k + 1
+        self.rows = rows
+
+    def view(self):
+        """:return: view of every recorded state, no copy is made"""
+        return self.states[..., :self.n_steps, :]
+
+    def row(self, row):
+        """:return: view of the states recorded by a single row"""
+        n_steps = self.n_steps if self.rows is None else self.rows[row]
+        return self.states[row, :n_steps]
+
+
+def take(rays, idx, attrs):
+    """
+    take of the 2D and 4D RayArrays
+    :param attrs: names of the per-ray arrays besides halt and halted_at, starting with the state, e.g. '_rt'
+    :return: copy of the rays idx sharing every other attribute, with an empty history if rays records its states
+    """
+    part = copy.copy(rays)
+    part.halt, part.halted_at = rays.halt[idx], rays.halted_at[idx]
+    for attr in attrs:
+        setattr(part, attr, getattr(rays, attr)[idx])
+
+    part.history = None
+    if rays.history is not None:
+        part.history = History((len(idx),), n_steps=rays.history.states.shape[-2], width=rays.history.states.shape[-1])
+
+    return part
+
+
+def put(rays, idx, part, attrs):
+    """
+    put of the 2D and 4D RayArrays, writes part = take(rays, idx, ...) back into rays
+    The states part recorded are added to the history step by step, every other ray repeats its last state
+    :param attrs: names of the per-ray arrays the tracing changes besides halt and halted_at, e.g. ('_rt', 'z')
+    """
+    rays.halt[idx], rays.halted_at[idx] = part.halt, part.halted_at
+    for attr in attrs:
+        getattr(rays, attr)[idx] = getattr(part, attr)
+
+    if rays.history is not None and part.history is not None:
+        for step in range(len(part.history)):
+            state = rays.history.next()
+            state[:] = rays.history.states[..., rays.history.n_steps - 2, :]
+            state[idx] = part.history.states[:, step, :]
+        part.history.n_steps = 0
+
+
 class Path(Ray):
     """keeps a record of past states everytime rt is changed"""
 	
-    def __init__(self, theta, r, z = -np.inf, n_current = 1, color = '#000000'):
-        # These lists must be created before the other init since it sets rt and set rt has calls to these
-        self.Pstates = []
-        self.tstates = []
+    def __init__(self, theta, r, z = -np.inf, n_current = 1, color = '#000000', history = True):
+        """
+        :param history: record every state in a History buffer, False keeps only the current state
+        """
+        # The history must be created before the other init since it sets rt and set rt records to it
+        self.history = History() if history else None
+        self.halted_at = -1  # index of the element that stopped the ray
         self.z = z
         super().__init__(theta, r, n_current=n_current, color=color)
 
+    @property
+    def Pstates(self):
+        """(n_steps, 2) view of the recorded r and z positions"""
+        if self.history is None:
+            return np.empty((0, 2))
+        return self.history.view()[:, ::2]
+
+    @property
+    def tstates(self):
+        """(n_steps,) view of the recorded angles"""
+        if self.history is None:
+            return np.empty(0)
+        return self.history.view()[:, 1]
+
     def __repr__(self):
         return f"Path - Current state: r = {self.rt[0]:.3f}, theta =  {self.rt[1]:.3f}, z = {self.z:.3f}"
 
@@ -41,17 +154,278 @@ class Path(Ray):
             return
 
         self._rt = value
-        self.tstates.append(self._rt[1])
-        P = np.array([self._rt[0], self.z])
-        self.Pstates.append(P)
+        if self.history is not None:
+            state = self.history.next()
+            state[:2] = value
+            state[2] = self.z
 
     def plot(self, ax, kwargs = {}):
-        Parray = np.array(self.Pstates).T
+        Parray = self.Pstates.T
         r = Parray[0]
         z = Parray[1]
 
         ax.plot(z, r, color = self.color, **kwargs)
-		
+
+
+class PathView(Path):
+    """
+    Path bound to ray ii of a RayArray, tracing it with calcPath changes the RayArray and records into its history
+    """
+
+    def __init__(self, rays, ii):
+        self.rays, self.ii = rays, ii
+        self.n = rays.n
+        self.color = rgb2hex8(rays.rgb(ii))
+
+    @property
+    def history(self):
+        return self.rays.history
+
+    @property
+    def z(self):
+        return float(self.rays.z[self.ii])
+
+    @z.setter
+    def z(self, value):
+        self.rays.z[self.ii] = value
+
+    @property
+    def halt(self):
+        return bool(self.rays.halt[self.ii])
+
+    @halt.setter
+    def halt(self, value):
+        self.rays.halt[self.ii] = value
+
+    @property
+    def halted_at(self):
+        return int(self.rays.halted_at[self.ii])
+
+    @halted_at.setter
+    def halted_at(self, value):
+        self.rays.halted_at[self.ii] = value
+
+    @property
+    def Pstates(self):
+        if self.history is None:
+            return np.empty((0, 2))
+        return self.history.row(self.ii)[:, ::2]
+
+    @property
+    def tstates(self):
+        if self.history is None:
+            return np.empty(0)
+        return self.history.row(self.ii)[:, 1]
+
+    @property
+    def rt(self):
+        return self.rays.rt[self.ii].copy()
+
+    @rt.setter
+    def rt(self, value):
+        if self.halt:
+            return
+
+        self.rays.rt[self.ii] = value
+        if self.history is not None:
+            self.history.record(self.ii, (*self.rays.rt[self.ii], self.z))
+
+
+class RayArray:
+    """
+    Structure-of-arrays bundle of rays for vectorized tracing
+    States are held as an (N, 2) array of (r, theta) together with a z vector and a halt mask
+    Past states are written in place into a History buffer of shape (N, n_steps, 3) holding r, theta and z
+    halted_at holds the index of the element that stopped each ray, -1 for rays that weren't stopped
+    Rays read from a dataset keep their colors as color_idx into a small palette, color looks them up on demand
+    """
+
+    palette = None  # (M, 3) rgb values of rays whose colors are held as color_idx, None for an (N, 3) color array
+
+    def __init__(self, theta, r, z = -np.inf, n_current = 1, color = '#000000', history = True):
+        """
+        :param theta: array of ray angles in radians
+        :param r: array of ray heights
+        :param z: axial position of the rays, scalar or array
+        :param n_current: starting index of refraction
+        :param color: hex string shared by all rays or (N, 3) array of rgb values
+        :param history: record every state, False keeps only the current state
+        """
+        r, theta = np.broadcast_arrays(np.asarray(r, dtype=np.float64),
+                                       np.asarray(theta, dtype=np.float64))
+        self.n = n_current
+        # halt, z and the history have to be done before self.rt
+        self.halt = np.zeros(r.shape, dtype=bool)
+        self.halted_at = np.full(r.shape, -1, dtype=np.int32)
+        self.z = np.array(np.broadcast_to(z, r.shape), dtype=np.float64)
+        self.history = History(r.shape) if history else None
+
+        self._rt = np.empty(r.shape + (2,), dtype=np.float64)
+        self.rt = np.stack([r, theta], axis=-1)
+
+        if isinstance(color, str):
+            color = np.tile(hex2rgb(color), (len(self), 1))
+        self.color = np.asarray(color, dtype=np.uint8)
+
+    def __len__(self):
+        return self.halt.shape[-1]
+
+    def __getitem__(self, item):
+        """
+        Slicing gives a RayArray sharing the state arrays of this one, the history is not shared
+        """
+        if not isinstance(item, slice):
+            raise TypeError("RayArray only supports slicing, use path() for single rays")
+
+        rays = RayArray.__new__(RayArray)
+        rays.n = self.n
+        rays.halt = self.halt[..., item]
+        rays.halted_at = self.halted_at[..., item]
+        rays.z = self.z[..., item]
+        rays.history = None
+        rays._rt = self._rt[..., item, :]
+        if self.palette is None:
+            rays.color = self.color[item]
+        else:
+            rays.palette, rays.color_idx = self.palette, self.color_idx[item]
+
+        return rays
+
+    def take(self, idx):
+        """
+        :param idx: array of ray indices
+        :return: RayArray copy of the rays idx, with an empty history if this one records its states
+        """
+        return take(self, idx, ('_rt', 'z', '_color' if self.palette is None else 'color_idx'))
+
+    def put(self, idx, rays):
+        """
+        Writes the rays of take(idx) back into this RayArray, the states they recorded are added to the history
+        and every other ray repeats its last state
+        """
+        put(self, idx, rays, ('_rt', 'z'))
+
+    def __repr__(self):
+        return f"RayArray - {len(self)} rays, {np.count_nonzero(self.halt)} halted"
+
+    @property
+    def rt(self):
+        return self._rt
+
+    @rt.setter
+    def rt(self, value):
+        # halted rays keep their last state, the same as Path does
+        np.copyto(self._rt, value, where=~self.halt[..., None])
+
+        if self.history is not None:
+            state = self.history.next()
+            state[..., :2] = self._rt
+            state[..., 2] = self.z
+            if self.history.n_steps > 1:
+                previous = self.history.states[..., self.history.n_steps - 2, :]
+                np.copyto(state, previous, where=self.halt[..., None])
+
+    @property
+    def color(self):
+        """(N, 3) unsigned 8 bit integer array of the ray colors"""
+        return self._color if self.palette is None else self.palette[self.color_idx]
+
+    @color.setter
+    def color(self, value):
+        self._color, self.palette = value, None
+
+    def rgb(self, idx):
+        """:return: colors of the rays idx, only those are looked up in the palette"""
+        return self._color[idx] if self.palette is None else self.palette[self.color_idx[idx]]
+
+    def get_rgb(self):
+        return self.color
+
+    def view(self, ii):
+        """
+        :return: PathView of ray ii, changes to it are made to this RayArray
+        """
+        return PathView(self, ii)
+
+    def path(self, ii):
+        """
+        :return: Path copy of ray ii, including its recorded history
+        """
+        r, theta = self.rt[ii]
+        path = Path(theta, r, z=self.z[ii], n_current=self.n, color=rgb2hex8(self.rgb(ii)))
+        path.halt = bool(self.halt[ii])
+        path.halted_at = int(self.halted_at[ii])
+
+        if self.history is not None:
+            path.history.states = self.history.row(ii).copy()
+            path.history.n_steps = len(path.history.states)
+
+        return path
+
+
+    def plot(self, ax, kwargs = {}, max_rays = None):
+        """
+        Draws the recorded paths of every ray as a single LineCollection, straight from the history buffer
+        :param kwargs: passed on to the LineCollection, e.g. linewidths or alpha
+        :param max_rays: display budget, evenly spaced rays are drawn when there are more rays than this
+        :return: the LineCollection
+        """
+        from matplotlib.collections import LineCollection
+
+        if self.history is None:
+            raise ValueError("RayArray has no recorded history to plot")
+
+        idx = np.arange(len(self))
+        if max_rays is not None and len(self) > max_rays:
+            idx = np.unique(np.linspace(0, len(self) - 1, max_rays).round().astype(np.intp))
+
+        lines = LineCollection(self.history.view()[idx][..., [2, 0]], colors=self.rgb(idx) / 255, **kwargs)
+        ax.add_collection(lines)
+        ax.autoscale_view()
+
+        return lines
+
+
+
+def chunks(source, chunk_size = 2**16):
+    """
+    Splits a source of rays into RayArrays of at most chunk_size rays, without history
+    :param source: Bundle, RayArray or an iterable of Paths or RayArray chunks
+    :return: generator of RayArray chunks
+    """
+    if hasattr(source, 'sample'):
+        for start in range(0, len(source), chunk_size):
+            yield source.sample(start, start + chunk_size, history=False)
+        return
+
+    if isinstance(source, RayArray):
+        for start in range(0, len(source), chunk_size):
+            yield source[start:start + chunk_size]
+        return
+
+    paths = []
+    for ray in source:
+        if isinstance(ray, RayArray):
+            yield ray
+            continue
+
+        paths.append(ray)
+        if len(paths) == chunk_size:
+            yield _gather(paths)
+            paths = []
+
+    if paths:
+        yield _gather(paths)
+
+
+def _gather(paths):
+    r, t = np.array([path.rt for path in paths]).T
+    rays = RayArray(t, r, z=[path.z for path in paths], n_current=paths[0].n,
+                    color=[path.get_rgb() for path in paths], history=False)
+    rays.halt[:] = [path.halt for path in paths]
+    rays.halted_at[:] = [getattr(path, 'halted_at', -1) for path in paths]
+
+    return rays
 
 class Bundle:
 
@@ -158,4 +532,4 @@ class PointSource(Bundle):
         return self.bundle[item]
 
     def __len__(self):
-        return self.num
\ No newline at end of file
+        return self.num
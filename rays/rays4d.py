@@ -1,6 +1,9 @@
 import numpy as np
 from dataclasses import dataclass
 from functools import lru_cache
+from ..colors import rgb2hex8, hex2rgb
+from . import rays2d
+from .rays2d import History
 
 @dataclass(frozen=True)
 class Ray():
@@ -13,6 +16,12 @@ class Ray():
     n : float = 1.0
     color : str = '#00FF00'
 
+    @classmethod
+    def fromState(cls, state, n = 1.0, color = '#00FF00'):
+        """Ray from a homogeneous (x, t, y, p, z, 1) state vector"""
+        x, t, y, p, z = state[:5]
+        return cls(x, y, t, p, z, n=n, color=color)
+
     @lru_cache()
     def state(self):
         return np.array([self.x,
@@ -24,39 +33,252 @@ class Ray():
                         dtype=np.float64)
 
 
-class Path(np.ndarray):
-
-    def __new__(cls, *ray_args, ray_kwargs, max_size=25):
-        return super().__new__(cls, shape=(max_size), dtype=Ray)
+class Path:
+    """
+    Record of the states of a single 4D ray
+    Every state is written as an (x, t, y, p, z, 1) row of a History buffer, 48 bytes per step, which grows as needed
+    """
 
-    def __init__(self, *ray_args, ray_kwargs = {}, max_size=25):
-        self.n_seg = 0 # number of straight path segments
-        self.state = Ray(*ray_args, **ray_kwargs)
+    def __init__(self, *ray_args, ray_kwargs = {}, history = True):
+        """
+        :param ray_args: x, y, t, p, z of the starting Ray
+        :param history: record every state, False keeps only the current state
+        """
+        ray = Ray(*ray_args, **ray_kwargs)
         self.halt = False
-        self.max_size = max_size
+        self.halted_at = -1  # index of the element that stopped the ray
+        self.history = History(width=6) if history else None  # has to be done before self.state
+
+        self._state = np.empty(6, dtype=np.float64)
+        self.state = ray
 
     def __len__(self):
-        return self.n_seg
+        return 1 if self.history is None else len(self.history)
 
     @property
     def state(self):
-        return self[self.n_seg - 1].state(),
+        return self._state
+
+    @state.setter
+    def state(self, ray):
+        if self.halt:
+            return
+
+        if isinstance(ray, Ray):
+            self.n, self.color = ray.n, ray.color
+            ray = (ray.x, ray.t, ray.y, ray.p, ray.z, 1)
+
+        self._state[:] = ray
+        if self.history is not None:
+            self.history.next()[:] = self._state
+
+    @property
+    def states(self):
+        """(n_steps, 6) view of the recorded states"""
+        if self.history is None:
+            return self._state[None, :]
+        return self.history.view()
+
+    def plot(self, ax3d):
+        states = self.states
+        ax3d.plot(states[:, 0], states[:, 2], states[:, 4], color = self.color)
+
+
+class PathView(Path):
+    """
+    Path bound to ray ii of a RayArray, tracing it with calcPath changes the RayArray and records into its history
+    """
+
+    def __init__(self, rays, ii):
+        self.rays, self.ii = rays, ii
+        self.n = rays.n
+        self.color = rgb2hex8(rays.palette[rays.color_idx[ii]])
+
+    def __len__(self):
+        return len(self.states)
+
+    @property
+    def history(self):
+        return self.rays.history
 
     @property
-    def color(self):
-        return self[self.n_seg - 1].color
+    def halt(self):
+        return bool(self.rays.halt[self.ii])
+
+    @halt.setter
+    def halt(self, value):
+        self.rays.halt[self.ii] = value
+
+    @property
+    def halted_at(self):
+        return int(self.rays.halted_at[self.ii])
+
+    @halted_at.setter
+    def halted_at(self, value):
+        self.rays.halted_at[self.ii] = value
+
+    @property
+    def state(self):
+        return self.rays.state[self.ii].copy()
 
     @state.setter
     def state(self, ray):
-        if not self.halt:
-            self[self.n_seg] = ray
-            self.n_seg += 1
+        if self.halt:
+            return
 
-        if self.n_seg == self.max_size:
-            self.halt = True
+        if isinstance(ray, Ray):
+            ray = (ray.x, ray.t, ray.y, ray.p, ray.z, 1)
 
-    def plot(self, ax3d):
-        ax3d.plot(self[:,0], self[:,1], self[:,2], color = self.color)
+        self.rays.state[self.ii] = ray
+        if self.history is not None:
+            self.history.record(self.ii, self.rays.state[self.ii])
+
+    @property
+    def states(self):
+        if self.history is None:
+            return self.state[None, :]
+        return self.history.row(self.ii)
+
+
+class RayArray:
+    """
+    Structure-of-arrays bundle of 4D rays for vectorized tracing
+    States are held as an (N, 6) array of homogeneous (x, t, y, p, z, 1) vectors together with a halt mask
+    Past states are written in place into a History buffer of shape (N, n_steps, 6)
+    halted_at holds the index of the element that stopped each ray, -1 for rays that weren't stopped
+    Colors are stored once in a small palette and every ray keeps a compact index into it
+    """
+
+    def __init__(self, x, y, t, p, z, n = 1.0, color = '#00FF00', history = True):
+        """
+        :param x, y: arrays of ray positions
+        :param t, p: arrays of ray angles in the x and y directions
+        :param z: axial position of the rays, scalar or array
+        :param n: index of refraction
+        :param color: hex string shared by all rays or (N, 3) array of rgb values
+        :param history: record every state, False keeps only the current state
+        """
+        x, y, t, p, z = np.broadcast_arrays(*[np.asarray(v, dtype=np.float64) for v in (x, y, t, p, z)])
+        self.n = n
+        # halt and the history have to be done before self.state
+        self.halt = np.zeros(x.shape, dtype=bool)
+        self.halted_at = np.full(x.shape, -1, dtype=np.int32)
+        self.history = History(x.shape, width=6) if history else None
+
+        self._state = np.empty(x.shape + (6,), dtype=np.float64)
+        self.state = np.stack([x, t, y, p, z, np.ones_like(x)], axis=-1)
+
+        if isinstance(color, str):
+            self.palette = hex2rgb(color)[None, :]
+            self.color_idx = np.zeros(x.shape, dtype=np.uint8)
+        else:
+            self.palette, color_idx = np.unique(np.reshape(color, (-1, 3)), axis=0, return_inverse=True)
+            self.color_idx = color_idx.reshape(x.shape).astype(np.min_scalar_type(len(self.palette)))
+
+    def __len__(self):
+        return self.halt.shape[-1]
+
+    def __getitem__(self, item):
+        """
+        Slicing gives a RayArray sharing the state arrays of this one, the history is not shared
+        """
+        if not isinstance(item, slice):
+            raise TypeError("RayArray only supports slicing, use path() for single rays")
+
+        rays = RayArray.__new__(RayArray)
+        rays.n = self.n
+        rays.halt = self.halt[..., item]
+        rays.halted_at = self.halted_at[..., item]
+        rays.history = None
+        rays._state = self._state[..., item, :]
+        rays.palette, rays.color_idx = self.palette, self.color_idx[..., item]
+
+        return rays
+
+    def take(self, idx):
+        """
+        :param idx: array of ray indices
+        :return: RayArray copy of the rays idx, with an empty history if this one records its states
+        """
+        return rays2d.take(self, idx, ('_state', 'color_idx'))
+
+    def put(self, idx, rays):
+        """
+        Writes the rays of take(idx) back into this RayArray, the states they recorded are added to the history
+        and every other ray repeats its last state
+        """
+        rays2d.put(self, idx, rays, ('_state',))
+
+    def __repr__(self):
+        return f"RayArray4d - {len(self)} rays, {np.count_nonzero(self.halt)} halted"
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        # halted rays keep their last state, the same as Path does
+        np.copyto(self._state, value, where=~self.halt[..., None])
+
+        if self.history is not None:
+            state = self.history.next()
+            state[:] = self._state
+            if self.history.n_steps > 1:
+                previous = self.history.states[..., self.history.n_steps - 2, :]
+                np.copyto(state, previous, where=self.halt[..., None])
+
+    @property
+    def z(self):
+        return self._state[..., 4]
+
+    def get_rgb(self):
+        """:return: (N, 3) array of the rgb color of every ray"""
+        return self.palette[self.color_idx]
+
+    def plot(self, ax3d, kwargs = {}, max_rays = None):
+        """
+        Draws the recorded paths of every ray as a single Line3DCollection, straight from the history buffer
+        :param kwargs: passed on to the Line3DCollection, e.g. linewidths or alpha
+        :param max_rays: display budget, evenly spaced rays are drawn when there are more rays than this
+        :return: the Line3DCollection
+        """
+        from mpl_toolkits.mplot3d.art3d import Line3DCollection
+
+        if self.history is None:
+            raise ValueError("RayArray has no recorded history to plot")
+
+        idx = np.arange(len(self))
+        if max_rays is not None and len(self) > max_rays:
+            idx = np.unique(np.linspace(0, len(self) - 1, max_rays).round().astype(np.intp))
+
+        paths = self.history.view()[idx][..., [0, 2, 4]]
+        lines = Line3DCollection(paths, colors=self.get_rgb()[idx] / 255, **kwargs)
+        ax3d.add_collection3d(lines)
+        ax3d.auto_scale_xyz(paths[..., 0], paths[..., 1], paths[..., 2], had_data=ax3d.has_data())
+
+        return lines
+
+    def view(self, ii):
+        """
+        :return: PathView of ray ii, changes to it are made to this RayArray
+        """
+        return PathView(self, ii)
+
+    def path(self, ii):
+        """
+        :return: Path copy of ray ii, including its recorded history
+        """
+        x, t, y, p, z = self.state[ii, :5]
+        path = Path(x, y, t, p, z, ray_kwargs=dict(n=self.n, color=rgb2hex8(self.palette[self.color_idx[ii]])))
+        path.halt = bool(self.halt[ii])
+        path.halted_at = int(self.halted_at[ii])
+
+        if self.history is not None:
+            path.history.states = self.history.row(ii).copy()
+            path.history.n_steps = len(path.history.states)
+
+        return path
 
 
 if __name__ == '__main__':
@@ -0,0 +1,155 @@
+"""
+Unit-cube samples for ray sources
+Every sample depends only on its index, so any range start to stop of a source, traced in chunks or by separate
+workers, gives the same rays as sampling it all at once
+
+grid:       evenly spaced np.linspace values, 1D only
+stratified: one jittered sample in each of num strata, a Latin hypercube in more than one dimension
+random:     uniform samples from a counter-based Philox stream
+halton:     Halton sequence with bases 2, 3, 5, 7, ...
+sobol:      Sobol sequence with Joe-Kuo direction numbers, up to 6 dimensions
+A seed randomizes halton and sobol (random shift and digital shift), random and stratified use seed 0 when none is given
+"""
+
+import math
+import numpy as np
+
+KINDS = ('grid', 'stratified', 'random', 'halton', 'sobol')
+
+PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+
+# Joe-Kuo new-joe-kuo-6.21201 direction numbers (s, a, m) for the dimensions after the first
+SOBOL = [(1, 0, (1,)),
+         (2, 1, (1, 3)),
+         (3, 1, (1, 3, 1)),
+         (3, 2, (1, 1, 1)),
+         (4, 1, (1, 1, 3, 3))]
+BITS = 32
+
+
+def unit(kind, num, dim = 1, start = 0, stop = None, seed = None):
+    """
+    Samples start to stop of a num sample set in [0, 1)^dim, [0, 1] for grid
+    :param kind: one of KINDS
+    :return: (stop - start, dim) array
+    """
+    ii = np.arange(*slice(start, stop).indices(num), dtype=np.int64)
+
+    if kind == 'grid':
+        if dim != 1:
+            raise ValueError("grid sampling is 1D only, use stratified, halton or sobol")
+        return (ii / max(num - 1, 1))[:, None]
+    elif kind == 'random':
+        return uniform(seed, ii[0] if len(ii) else 0, len(ii), dim)
+    elif kind == 'stratified':
+        return stratified(ii, num, dim, seed)
+    elif kind == 'halton':
+        return halton(ii, dim, seed)
+    elif kind == 'sobol':
+        return sobol(ii, dim, seed)
+
+    raise ValueError(f"Unknown sampling {kind}, use one of {KINDS}")
+
+
+def generator(seed, counter = 0):
+    """:return: Philox Generator of seed, advanced to its counter-th block of four 64 bit draws"""
+    key = np.random.SeedSequence(0 if seed is None else seed).generate_state(2, np.uint64)
+    bit_generator = np.random.Philox(key=key)
+    bit_generator.advance(counter)
+    return np.random.Generator(bit_generator)
+
+
+def uniform(seed, start, n, dim = 1):
+    """:return: (n, dim) uniform samples of rows start to start + n of the seed's stream"""
+    offset = int(start) * dim
+    rng = generator(seed, offset // 4)
+    rng.random(offset % 4)
+    return rng.random((n, dim))
+
+
+def stratified(ii, num, dim = 1, seed = None):
+    """
+    One jittered sample per stratum, the strata of every dimension after the first are visited in the order of an
+    affine permutation (a i + b) mod num, so every dimension stays stratified
+    """
+    jitter = uniform(seed, ii[0] if len(ii) else 0, len(ii), dim)
+
+    strata = np.empty((len(ii), dim), dtype=np.int64)
+    strata[:, 0] = ii
+    rng = generator(seed, 2**48)  # kept apart from the jitter stream
+    for d in range(1, dim):
+        a = int(rng.integers(1, max(num, 2)))
+        while math.gcd(a, num) != 1:
+            a += 1
+        strata[:, d] = (a * ii + int(rng.integers(num))) % num
+
+    return (strata + jitter) / num
+
+
+def halton(ii, dim = 1, seed = None):
+    """Halton points of indices ii, randomly shifted modulo 1 when seeded"""
+    if dim > len(PRIMES):
+        raise ValueError(f"halton sampling is implemented up to {len(PRIMES)} dimensions")
+
+    points = np.empty((len(ii), dim))
+    for d, base in enumerate(PRIMES[:dim]):
+        n, f, value = ii.copy(), 1.0, np.zeros(len(ii))
+        while np.any(n > 0):
+            f /= base
+            value += f * (n % base)
+            n //= base
+        points[:, d] = value
+
+    if seed is not None:
+        points = (points + generator(seed).random(dim)) % 1
+    return points
+
+
+def directions(dim):
+    """:return: (dim, BITS) Sobol direction numbers as integers scaled by 2**BITS"""
+    if dim > len(SOBOL) + 1:
+        raise ValueError(f"sobol sampling is implemented up to {len(SOBOL) + 1} dimensions")
+
+    V = np.zeros((dim, BITS), dtype=np.uint64)
+    V[0] = [1 << (BITS - 1 - k) for k in range(BITS)]
+    for d, (s, a, m) in enumerate(SOBOL[:dim - 1], start=1):
+        v = [m_k << (BITS - 1 - k) for k, m_k in enumerate(m)]
+        for k in range(s, BITS):
+            x = v[k - s] ^ (v[k - s] >> s)
+            for j in range(1, s):
+                x ^= ((a >> (s - 1 - j)) & 1) * v[k - j]
+            v.append(x)
+        V[d] = v
+
+    return V
+
+
+def sobol(ii, dim = 1, seed = None):
+    """Sobol points of indices ii in gray code order, digitally shifted when seeded"""
+    V = directions(dim)
+    gray = (ii ^ (ii >> 1)).astype(np.uint64)
+
+    x = np.zeros((len(ii), dim), dtype=np.uint64)
+    for k in range(BITS):
+        bit = (gray >> np.uint64(k)) & np.uint64(1)
+        x ^= bit[:, None] * V[:, k]
+
+    if seed is not None:
+        x ^= generator(seed).integers(0, 2**BITS, dim, dtype=np.uint64)
+    return x / 2.0**BITS
+
+
+def disc(u):
+    """
+    Maps (n, 2) unit samples onto the unit disc with the concentric mapping, which keeps their stratification
+    :return: x and y arrays
+    """
+    a, b = 2*u[:, 0] - 1, 2*u[:, 1] - 1
+    wide = np.abs(a) > np.abs(b)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = np.where(wide, a, b)
+        phi = np.where(wide, np.pi/4 * b/a, np.pi/2 - np.pi/4 * a/b)
+    phi = np.nan_to_num(phi)
+
+    return r * np.cos(phi), r * np.sin(phi)
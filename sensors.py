@@ -1,3 +1,54 @@
+import copy
+import itertools
+import numpy as np
+from .rays.rays2d import RayArray, chunks
+from .rays import rays4d
+from . import dataset
+from .colors import hex2rgb
+
+
+def _chunks(ray, chunk_size = 2**16):
+    """
+    :return: the rays added to a sensor, a RayDataset is read from its files one chunk of rays at a time
+    """
+    if isinstance(ray, dataset.RayDataset):
+        return chunks(ray, chunk_size)
+    return [ray]
+
+
+def _arrays2d(ray):
+    """
+    Arrays of 2D rays added to a sensor
+    :param ray: RayArray, Bundle, Path or sequence of Paths
+    :return: ray heights, angles, (N, 3) colors and halt mask
+    """
+    if hasattr(ray, 'asArray'):
+        ray = ray.asArray()
+    if isinstance(ray, RayArray):
+        return ray.rt[..., 0], ray.rt[..., 1], np.broadcast_to(ray.get_rgb(), ray.halt.shape + (3,)), ray.halt
+
+    rays = [ray[ii] for ii in range(len(ray))] if hasattr(ray, '__getitem__') else [ray]
+    return [r.rt[0] for r in rays], [r.rt[1] for r in rays], [r.get_rgb() for r in rays], [r.halt for r in rays]
+
+
+def _arrays4d(ray):
+    """
+    Arrays of 4D rays added to a sensor
+    :param ray: rays4d.RayArray, Bundle, Path or list of Paths
+    :return: x, y, t and p of the rays, index of the color of each ray in palette, palette and halt mask
+    """
+    if hasattr(ray, 'asArray'):
+        ray = ray.asArray()
+    if isinstance(ray, rays4d.RayArray):
+        state = ray.state
+        return state[..., 0], state[..., 2], state[..., 1], state[..., 3], ray.color_idx, ray.palette, ray.halt
+
+    paths = list(ray) if isinstance(ray, (list, tuple)) else [ray]
+    palette, color_idx = np.unique([hex2rgb(path.color) for path in paths], axis=0, return_inverse=True)
+    x, t, y, p = np.array([path.state[:4] for path in paths]).reshape(-1, 4).T
+    return x, y, t, p, color_idx.ravel(), palette, [path.halt for path in paths]
+
+
 class Image:
     def __init__(self, extent, sens_size, intensity = .1):
         self.r_max = extent
@@ -5,6 +56,13 @@ class Image:
         self.img = np.zeros((self.n_px, 3), dtype = np.float64)
         self.intensity = intensity
 
+    @classmethod
+    def fromArray(cls, extent, img, intensity = .1):
+        """:return: Image of half width extent holding an (n_px, 3) img array"""
+        image = cls.__new__(cls)
+        image.r_max, image.n_px, image.img, image.intensity = extent, len(img), img, intensity
+        return image
+
     def Add(self, ray):
         """Creates an image using a sample of rays using their color and """
         if ray.halt:
@@ -26,11 +84,59 @@ class Image:
         self.img[img_idx_u] += ray.get_rgb() * idx_frac * self.intensity
         self.img[img_idx_l] += ray.get_rgb() * (1 - idx_frac) * self.intensity
 
+    def add_bundle(self, r, rgb, halt = None):
+        """
+        Vectorized Add, every ray is splatted into the image in a single bincount pass
+        :param r: array of final ray heights
+        :param rgb: (N, 3) array of ray colors
+        :param halt: optional mask of halted rays, which are skipped
+        """
+        self.img += self.splat(np.ravel(r)[None, :], rgb, halt)[0]
+
+    def splat(self, r, rgb, halt = None):
+        """
+        Bins the rays into one image per row of r, all of them in a single bincount pass
+        :param r: (n_planes, N) array of ray heights
+        :param rgb: (N, 3) array of ray colors
+        :param halt: optional mask of halted rays, which are skipped
+        :return: (n_planes, n_px, 3) array of the binned rays
+        """
+        r = np.asarray(r, dtype=np.float64)
+        rgb = np.reshape(rgb, (-1, 3))
+
+        keep = np.abs(r / self.r_max) <= 1
+        if halt is not None:
+            keep &= ~np.ravel(halt)
+        plane, ray = np.nonzero(keep)
+
+        img_idx_u, img_idx_l, idx_frac = self.pixels(r[plane, ray])
+        idx_frac = idx_frac[:, None]
+        weights = rgb[ray] * self.intensity
+
+        # each pixel channel of each plane gets its own bin so the whole splat is one bincount
+        offset = plane * self.n_px
+        idx = np.concatenate([offset + img_idx_u, offset + img_idx_l])[:, None]*3 + np.arange(3)
+        weights = np.concatenate([weights * idx_frac, weights * (1 - idx_frac)])
+
+        img = np.bincount(idx.ravel(), weights.ravel(), minlength=3*self.n_px*len(r))
+        return img.reshape(len(r), self.n_px, 3)
+
+    def pixels(self, r):
+        """
+        Bilinear footprint of ray heights that fall on the sensor
+        :return: upper and lower pixel of every height and the fraction of the ray given to the upper one
+        """
+        img_idx = .5*(1 - r / self.r_max)*(self.n_px-1)
+
+        img_idx_l = np.floor(img_idx).astype(np.intp)
+        img_idx_u = np.ceil(img_idx).astype(np.intp)
+
+        return img_idx_u, img_idx_l, img_idx - img_idx_l
+
     def __add__(self, ray):
-        if hasattr(ray, '__getitem__'):
-            for ii in range(len(ray)):
-                self.Add(ray[ii])
-        else: self.Add(ray)
+        for rays in _chunks(ray):
+            r, _, rgb, halt = _arrays2d(rays)
+            self.add_bundle(r, rgb, halt)
 
     def cap(self, max = 255):
         over = self.img > max
@@ -38,6 +144,7 @@ class Image:
 
     def Display(self, show = True, ax = None, width = 10, title = ''):
         if ax is None:
+            import matplotlib.pyplot as pyp
             fig, ax = pyp.subplots(dpi = 200, figsize = (.015 * width, .015 * self.n_px))
 
         self.img2d = np.array(width * [self.img], dtype = np.float64)
@@ -48,4 +155,353 @@ class Image:
         ax.set_title(title)
 
         if show:
-            fig.show()
\ No newline at end of file
+            fig.show()
+
+class AngleImage(Image):
+    """
+    Base of the sensors whose add_bundle takes the angles of the rays as well as their heights
+    """
+    def Add(self, ray):
+        self + [ray]
+
+    def __add__(self, ray):
+        for rays in _chunks(ray):
+            self.add_bundle(*_arrays2d(rays))
+
+
+class ZStack(AngleImage):
+    """
+    Images of the same rays at many axial planes, img has shape (n_z, n_px, 3)
+    Rays are added at the end of the last element of a system, see lin2d.OpticsSystem.zstack, and every plane is
+    reached analytically by moving them r + L theta
+    """
+    def __init__(self, extent, sens_size, distances, intensity = .1, block = 2**22):
+        """
+        :param distances: array of distances of the planes behind the last element
+        :param block: largest number of ray positions binned at once, bounds the memory used per chunk of rays
+        """
+        super().__init__(extent, sens_size, intensity=intensity)
+        self.distances = np.ravel(distances).astype(np.float64)
+        self.img = np.zeros((len(self.distances), self.n_px, 3), dtype = np.float64)
+        self.block = block
+
+    def add_bundle(self, r, t, rgb, halt = None):
+        """
+        :param r, t: arrays of ray heights and angles at the end of the last element
+        :param rgb: (N, 3) array of ray colors
+        :param halt: optional mask of halted rays, which are skipped
+        """
+        r, t = np.ravel(r), np.ravel(t)
+        n_planes = max(1, self.block // max(1, len(r)))
+
+        for start in range(0, len(self.distances), n_planes):
+            L = self.distances[start:start + n_planes, None]
+            self.img[start:start + n_planes] += self.splat(r + L*t, rgb, halt)
+
+    def __getitem__(self, plane):
+        """:return: Image of a single plane of the stack"""
+        return Image.fromArray(self.r_max, self.img[plane], intensity=self.intensity)
+
+    def Display(self, show = True, ax = None, title = ''):
+        if ax is None:
+            import matplotlib.pyplot as pyp
+            fig, ax = pyp.subplots(dpi = 200)
+
+        img = np.swapaxes(self.img, 0, 1) / np.max(self.img)
+        ax.imshow(img, aspect = 'auto',
+                  extent = (self.distances[0], self.distances[-1], -self.r_max, self.r_max))
+        ax.set_xlabel('distance')
+        ax.set_title(title)
+
+        if show:
+            fig.show()
+
+
+class PhaseSpace(AngleImage):
+    """
+    Light field of a 2D trace, the final (r, theta) of every ray is binned into an (n_px, n_theta, 3) histogram
+    Heights are splatted into the pixels of Image the same way, angles go to the nearest of n_theta bins, so images
+    at other distances behind the sensor plane or through a smaller aperture are array operations on the histogram
+    Only rays that land on the sensor are recorded, the extent has to cover the rays of every refocused image
+    """
+    def __init__(self, extent, sens_size, theta_max, n_theta = 32, intensity = .1):
+        """
+        :param theta_max: largest angle that is recorded, the bins span -theta_max to theta_max
+        :param n_theta: number of angle bins
+        """
+        super().__init__(extent, sens_size, intensity=intensity)
+        self.dt = 2 * theta_max / n_theta
+        self.t = (np.arange(n_theta) + .5) * self.dt - theta_max  # centers of the angle bins
+        self.img = np.zeros((self.n_px, n_theta, 3), dtype = np.float64)
+
+    def add_bundle(self, r, t, rgb, halt = None):
+        """
+        Bins every ray in a single bincount pass
+        :param r, t: arrays of final ray heights and angles
+        :param rgb: (N, 3) array of ray colors
+        :param halt: optional mask of halted rays, which are skipped
+        """
+        r, t = np.ravel(r), np.ravel(t)
+        rgb = np.reshape(rgb, (-1, 3))
+        angle = np.floor((t - self.t[0]) / self.dt + .5).astype(np.intp)
+
+        keep = (np.abs(r / self.r_max) <= 1) & (angle >= 0) & (angle < len(self.t))
+        if halt is not None:
+            keep &= ~np.ravel(halt)
+        ray = np.flatnonzero(keep)
+
+        img_idx_u, img_idx_l, idx_frac = self.pixels(r[ray])
+        cell = np.concatenate([img_idx_u, img_idx_l]) * len(self.t) + np.tile(angle[ray], 2)
+        weights = rgb[ray] * self.intensity
+        weights = np.concatenate([weights * idx_frac[:, None], weights * (1 - idx_frac[:, None])])
+
+        idx = cell[:, None]*3 + np.arange(3)
+        self.img += np.bincount(idx.ravel(), weights.ravel(), minlength=self.img.size).reshape(self.img.shape)
+
+    def project(self):
+        """:return: Image of the recorded rays, the same as an Image the rays were added to"""
+        return Image.fromArray(self.r_max, self.img.sum(axis=1), intensity=self.intensity)
+
+    def refocus(self, distance):
+        """
+        Image at a distance behind the plane the rays were recorded at, no rays are traced
+        Every angle bin is moved by distance * theta, the image is blurred by up to distance times half a bin
+        :return: Image
+        """
+        # pixels run from +r_max to -r_max
+        shifts = -distance * self.t[:, None] * (self.n_px - 1) / (2 * self.r_max)
+        return Image.fromArray(self.r_max, _shear(self.img, shifts), intensity=self.intensity)
+
+    def aperture(self, t_min, t_max):
+        """
+        Synthetic aperture, only the angle bins centered within t_min to t_max are kept
+        :return: PhaseSpace of the kept bins
+        """
+        lo, hi = np.searchsorted(self.t, t_min), np.searchsorted(self.t, t_max, side='right')
+        cropped = copy.copy(self)
+        cropped.t, cropped.img = self.t[lo:hi], self.img[:, lo:hi].copy()
+        return cropped
+
+    def Display(self, show = True, ax = None, title = ''):
+        if ax is None:
+            import matplotlib.pyplot as pyp
+            fig, ax = pyp.subplots(dpi = 200)
+
+        ax.imshow(self.img / np.max(self.img), aspect = 'auto',
+                  extent = (self.t[0] - self.dt / 2, self.t[-1] + self.dt / 2, -self.r_max, self.r_max))
+        ax.set_xlabel('theta')
+        ax.set_title(title)
+
+        if show:
+            fig.show()
+
+
+class Image2D:
+    """
+    Sensor for 4D traces, the final x, y position of every ray is splatted bilinearly into an (n_y, n_x, 3) image
+    Rays are added with image + rays, so chunks of a streaming trace accumulate into the same image
+    """
+    def __init__(self, extent, pitch, intensity = .1, dtype = np.float64):
+        """
+        :param extent: half width of the sensor, or (x, y) half widths
+        :param pitch: pixel pitch, a pixel is centered on the optical axis
+        :param dtype: np.float32 halves the memory of the image
+        """
+        self.x_max, self.y_max = np.broadcast_to(extent, 2)
+        self.pitch = pitch
+        self.n_x = int(2 * np.ceil(self.x_max / pitch) + 1)
+        self.n_y = int(2 * np.ceil(self.y_max / pitch) + 1)
+        self.img = np.zeros((self.n_y, self.n_x, 3), dtype = dtype)
+        self.intensity = intensity
+
+    @classmethod
+    def fromArray(cls, extent, pitch, img, intensity = .1):
+        """:return: Image2D of half widths extent holding an (n_y, n_x, 3) img array"""
+        image = cls.__new__(cls)
+        image.x_max, image.y_max = np.broadcast_to(extent, 2)
+        image.pitch, image.img, image.intensity = pitch, img, intensity
+        image.n_y, image.n_x = img.shape[:2]
+        return image
+
+    def add_bundle(self, x, y, color_idx, palette, halt = None):
+        """
+        Splats every ray into its four closest pixels in a single bincount pass
+        :param x, y: arrays of final ray positions
+        :param color_idx: index of the color of each ray in palette
+        :param palette: (M, 3) array of rgb values
+        :param halt: optional mask of halted rays, which are skipped
+        """
+        img = self.splat(x, y, color_idx, palette, halt)
+        self.img += img.reshape(self.img.shape).astype(self.img.dtype, copy=False)
+
+    def splat(self, x, y, color_idx, palette, halt = None, cell = None, n_cells = 1):
+        """
+        Bins the rays into their four closest pixels
+        :param cell: optional index of a sub-bin of the pixels for every ray, such as its angle bin, out of n_cells
+        :return: (n_y * n_x * n_cells, 3) array of the binned rays
+        """
+        # continuous pixel coordinates, the image rows run from +y to -y
+        col = np.ravel(x) / self.pitch + (self.n_x - 1) / 2
+        row = (self.n_y - 1) / 2 - np.ravel(y) / self.pitch
+
+        keep = (col >= 0) & (col <= self.n_x - 1) & (row >= 0) & (row <= self.n_y - 1)
+        if halt is not None:
+            keep &= ~np.ravel(halt)
+        col, row = col[keep], row[keep]
+        color_idx = np.broadcast_to(color_idx, keep.shape)[keep]
+
+        col_l, row_l = np.floor(col).astype(np.intp), np.floor(row).astype(np.intp)
+        col_f, row_f = col - col_l, row - row_l
+        col_u, row_u = np.minimum(col_l + 1, self.n_x - 1), np.minimum(row_l + 1, self.n_y - 1)
+
+        pixel = np.concatenate([row_l*self.n_x + col_l, row_l*self.n_x + col_u,
+                                row_u*self.n_x + col_l, row_u*self.n_x + col_u])
+        weight = self.intensity * np.concatenate([(1 - row_f)*(1 - col_f), (1 - row_f)*col_f,
+                                                  row_f*(1 - col_f), row_f*col_f])
+        color_idx = np.tile(color_idx, 4)
+        if cell is not None:
+            pixel = pixel * n_cells + np.tile(np.broadcast_to(cell, keep.shape)[keep], 4)
+
+        n_pixels, palette = self.n_x * self.n_y * n_cells, np.reshape(palette, (-1, 3)).astype(np.float64)
+        if len(palette) <= 3:
+            # few colors, bin the weight of each color and mix the colors in afterwards
+            binned = np.bincount(pixel*len(palette) + color_idx, weight, minlength=n_pixels*len(palette))
+            img = binned.reshape(n_pixels, len(palette)) @ palette
+        else:
+            idx = pixel[:, None]*3 + np.arange(3)
+            binned = np.bincount(idx.ravel(), (palette[color_idx] * weight[:, None]).ravel(), minlength=3*n_pixels)
+            img = binned.reshape(n_pixels, 3)
+
+        return img
+
+    def __add__(self, ray):
+        for rays in _chunks(ray):
+            x, y, _, _, color_idx, palette, halt = _arrays4d(rays)
+            self.add_bundle(x, y, color_idx, palette, halt)
+
+    def cap(self, max = 255):
+        over = self.img > max
+        self.img[over] = max
+
+    def Display(self, show = True, ax = None, title = ''):
+        if ax is None:
+            import matplotlib.pyplot as pyp
+            fig, ax = pyp.subplots(dpi = 200)
+
+        half_x, half_y = self.n_x * self.pitch / 2, self.n_y * self.pitch / 2
+        ax.imshow(self.img / np.max(self.img), extent = (-half_x, half_x, -half_y, half_y))
+        ax.set_title(title)
+
+        if show:
+            fig.show()
+
+
+class PhaseSpace4D(Image2D):
+    """
+    Light field of a 4D trace, the final (x, y, t, p) of every ray is binned into an (n_y, n_x, n_p, n_t, 3) histogram
+    Positions are splatted into the pixels of Image2D the same way, angles go to the nearest angle bin
+    Only rays that land on the sensor are recorded, the extent has to cover the rays of every refocused image
+    """
+    def __init__(self, extent, pitch, theta_max, n_theta = 9, intensity = .1, dtype = np.float32):
+        """
+        :param theta_max: largest angle that is recorded, or (t, p) largest angles
+        :param n_theta: number of angle bins along t and p, or (n_t, n_p)
+        :param dtype: np.float64 doubles the memory of the histogram
+        """
+        super().__init__(extent, pitch, intensity=intensity, dtype=dtype)
+        t_max, p_max = np.broadcast_to(theta_max, 2)
+        n_t, n_p = np.broadcast_to(n_theta, 2)
+
+        self.dt, self.dp = 2 * t_max / n_t, 2 * p_max / n_p
+        self.t = (np.arange(n_t) + .5) * self.dt - t_max  # centers of the angle bins
+        self.p = (np.arange(n_p) + .5) * self.dp - p_max
+        self.img = np.zeros((self.n_y, self.n_x, n_p, n_t, 3), dtype = dtype)
+
+    def add_bundle(self, x, y, t, p, color_idx, palette, halt = None):
+        """
+        Splats every ray into the angle bin of its four closest pixels in a single bincount pass
+        :param x, y: arrays of final ray positions
+        :param t, p: arrays of final ray angles
+        """
+        col = np.floor((np.ravel(t) - self.t[0]) / self.dt + .5).astype(np.intp)
+        row = np.floor((np.ravel(p) - self.p[0]) / self.dp + .5).astype(np.intp)
+
+        outside = (col < 0) | (col >= len(self.t)) | (row < 0) | (row >= len(self.p))
+        if halt is not None:
+            outside |= np.ravel(halt)
+
+        img = self.splat(x, y, color_idx, palette, outside, cell=row*len(self.t) + col, n_cells=self.n_angles)
+        self.img += img.reshape(self.img.shape).astype(self.img.dtype, copy=False)
+
+    @property
+    def n_angles(self):
+        return len(self.p) * len(self.t)
+
+    def __add__(self, ray):
+        for rays in _chunks(ray):
+            self.add_bundle(*_arrays4d(rays))
+
+    def project(self):
+        """:return: Image2D of the recorded rays, the same as an Image2D the rays were added to"""
+        img = self.img.sum(axis=(2, 3), dtype=np.float64).astype(self.img.dtype)
+        return Image2D.fromArray((self.x_max, self.y_max), self.pitch, img, intensity=self.intensity)
+
+    def refocus(self, distance):
+        """
+        Image at a distance behind the plane the rays were recorded at, no rays are traced
+        Every angle bin is moved by distance * (t, p), the image is blurred by up to distance times half a bin
+        :return: Image2D
+        """
+        p, t = np.meshgrid(self.p, self.t, indexing='ij')
+        # rows run from +y to -y
+        shifts = np.stack([-distance * p.ravel(), distance * t.ravel()], axis=-1) / self.pitch
+        img = _shear(self.img.reshape(self.n_y, self.n_x, self.n_angles, 3), shifts).astype(self.img.dtype)
+        return Image2D.fromArray((self.x_max, self.y_max), self.pitch, img, intensity=self.intensity)
+
+    def aperture(self, radius, center = (0, 0)):
+        """
+        Synthetic round aperture, only the angle bins centered within radius of center in (t, p) are kept
+        :return: PhaseSpace4D cropped to the kept bins
+        """
+        t0, p0 = center
+        t_lo, t_hi = np.searchsorted(self.t, t0 - radius), np.searchsorted(self.t, t0 + radius, side='right')
+        p_lo, p_hi = np.searchsorted(self.p, p0 - radius), np.searchsorted(self.p, p0 + radius, side='right')
+
+        cropped = copy.copy(self)
+        cropped.t, cropped.p = self.t[t_lo:t_hi], self.p[p_lo:p_hi]
+        cropped.img = self.img[:, :, p_lo:p_hi, t_lo:t_hi].copy()
+        outside = (cropped.p[:, None] - p0)**2 + (cropped.t[None, :] - t0)**2 > radius**2
+        cropped.img[:, :, outside] = 0
+        return cropped
+
+    def Display(self, show = True, ax = None, title = ''):
+        self.project().Display(show=show, ax=ax, title=title)
+
+
+def _shear(hist, shifts):
+    """
+    Sums the angle bins of a histogram, each moved by its own shift of the pixel coordinates
+    Fractional shifts are split linearly between the neighbouring pixels, parts moved off the sensor are dropped
+    :param hist: (*pixels, n_angles, 3) histogram
+    :param shifts: (n_angles, len(pixels)) shift of every angle bin in pixels
+    :return: (*pixels, 3) image
+    """
+    img = np.zeros(hist.shape[:-2] + hist.shape[-1:], dtype=np.float64)
+    for angle, shift in enumerate(np.asarray(shifts, dtype=np.float64)):
+        base = np.floor(shift)
+        frac = shift - base
+        for corner in itertools.product((0, 1), repeat=len(shift)):
+            weight = np.prod([f if c else 1 - f for c, f in zip(corner, frac)])
+            if weight > 0:
+                _shift_add(img, hist[..., angle, :], [int(b) + c for b, c in zip(base, corner)], weight)
+
+    return img
+
+
+def _shift_add(out, a, shift, weight):
+    """Adds weight * a to out moved by an integer shift along its leading axes"""
+    src, dst = [], []
+    for s, n in zip(shift, a.shape):
+        src.append(slice(max(0, -s), max(0, min(n, n - s))))
+        dst.append(slice(max(0, s), max(0, min(n, n + s))))
+    out[tuple(dst)] += weight * a[tuple(src)]
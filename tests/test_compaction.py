@@ -0,0 +1,53 @@
+import numpy as np
+from ..elements import lin2d, lin4d
+
+
+def stops_2d():
+    return lin2d.OpticsSystem([lin2d.ThinLens(50, loc=0), lin2d.Stop(3, loc=10), lin2d.ThinLens(-40, loc=20),
+                               lin2d.Stop(2, loc=30), lin2d.Stop(1, loc=40), lin2d.ThinLens(25, loc=50)],
+                              propagate=25)
+
+
+def stops_4d():
+    return lin4d.OpticsSystem([lin4d.ThinLens(50, np.inf, 0), lin4d.StopCirc(3, 10), lin4d.ThinLens(-40, np.inf, 20),
+                               lin4d.StopCirc(2, 30), lin4d.StopCirc(1, 40), lin4d.ThinLens(25, np.inf, 50)],
+                              propagate=25)
+
+
+def assert_same(a, b, state):
+    np.testing.assert_allclose(getattr(a, state), getattr(b, state))
+    np.testing.assert_array_equal(a.halt, b.halt)
+    np.testing.assert_array_equal(a.halted_at, b.halted_at)
+    np.testing.assert_allclose(a.history.view(), b.history.view())
+
+
+def test_compaction_2d():
+    system = stops_2d()
+    never, always = [system.trace(lin2d.CollimatedSource(5, num=64, zstart=-10, theta=.02).asArray(), compact=compact)
+                     for compact in (0, 1)]
+
+    source = lin2d.CollimatedSource(5, num=64, zstart=-10, theta=.02)
+    for path in source:
+        system.calcPath(path)
+    scalar = source.asArray()
+
+    assert 0 < np.count_nonzero(never.halt) < len(never)
+    assert len(np.unique(never.halted_at)) > 2
+    assert_same(never, always, 'rt')
+    assert_same(never, scalar, 'rt')
+
+
+def test_compaction_4d():
+    system = stops_4d()
+    never, always = [system.trace(lin4d.CollimatedSource(5, num=64).asArray(), compact=compact)
+                     for compact in (0, 1)]
+
+    source = lin4d.CollimatedSource(5, num=64)
+    for path in source:
+        system.calcPath(path)
+    scalar = source.asArray()
+
+    assert 0 < np.count_nonzero(never.halt) < len(never)
+    assert len(np.unique(never.halted_at)) > 2
+    assert_same(never, always, 'state')
+    assert_same(never, scalar, 'state')
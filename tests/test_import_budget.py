@@ -0,0 +1,5 @@
+from .. import benchmarks
+
+
+def test_import_budget():
+    assert benchmarks.check_imports()